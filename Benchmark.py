@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import gzip
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import EnaXml
+import EnaSqlite
+import EnaMock
+import GetMetadata
+
+## ENAupload needs requests, so it is only imported by the stages that use it
+def enaupload():
+    import ENAupload
+    return ENAupload
+
+def output(verbose):
+    """Context hiding what the code under test prints unless verbose"""
+    if verbose:
+        return contextlib.nullcontext()
+    return contextlib.redirect_stdout(io.StringIO())
+
+def make_fastq_pairs(directory, isolates, reads=10000, read_length=150, seed=0):
+    """Write gzipped R1/R2 fastqs of random reads for isolates BENCH000000,
+    ... into directory. Returns the list of path pairs."""
+    rand = random.Random(seed)
+    bases = bytes(b"ACGT"[i % 4] for i in range(256))
+    quality = b"F" * read_length
+    pairs = list()
+    for i in range(isolates):
+        alias = "BENCH{:06d}".format(i)
+        pair = list()
+        for read in ("R1", "R2"):
+            path = os.path.join(directory, "{}_S1_L001_{}_001.fastq.gz".format(alias, read))
+            with gzip.open(path, 'wb', compresslevel=1) as fh:
+                for n in range(reads):
+                    fh.write(b"@%s:%d/%s\n%s\n+\n%s\n" % (
+                        alias.encode(), n, read[1:].encode(),
+                        rand.randbytes(read_length).translate(bases), quality))
+            pair.append(path)
+        pairs.append(pair)
+    return pairs
+
+def make_isolate_export(path, isolates, seed=0):
+    """Write an isolate export in the format GetMetadata reads"""
+    rand = random.Random(seed)
+    countries = ["DANMARK", "SPANIEN", "THAILAND", "TYRKIET", ""]
+    with open(path, 'w') as fh:
+        fh.write("Key\tSerotype\tST\tReceived\tCountry\n")
+        for i in range(isolates):
+            fh.write("BENCH{:06d}\tTyphimurium\t{}\t{:02d}-{:02d}-2019\t{}\n".format(
+                i, rand.choice([19, 34, 36]), rand.randint(1, 28), rand.randint(1, 12),
+                rand.choice(countries)))
+
+def synthetic_attributes(i):
+    return {'ENA_CHECKLIST':'ERC000029',
+            'collected_by':'Statens Serum Institute',
+            'geographic location':'Denmark',
+            'isolate':"BENCH{:06d}".format(i),
+            'serovar':'Typhimurium',
+            'sub_type':'ST19',
+            'collection date':'2019-03',
+            'travel-relation':'not travel-related'}
+
+def build_and_serialize(isolates, chunk_size):
+    """Build sample, experiment and run XML for synthetic isolates and
+    serialize it in chunks. Returns (build seconds, serialize seconds, bytes)."""
+    start = time.perf_counter()
+    sets = {'SAMPLE_SET': list(), 'EXPERIMENT_SET': list(), 'RUN_SET': list()}
+    for i in range(isolates):
+        alias = "BENCH{:06d}".format(i)
+        sets['SAMPLE_SET'].append(EnaXml.sample_element(alias, 28901, synthetic_attributes(i)))
+        sets['EXPERIMENT_SET'].append(EnaXml.experiment_element(
+            "exp_"+alias, alias, "BENCH", "SSI",
+            GetMetadata.library_template(), GetMetadata.platform_template()))
+        sets['RUN_SET'].append(EnaXml.run_element(
+            "run_"+alias, "exp_"+alias, "SSI",
+            [(alias+"_R1.fastq.gz", "0"*32), (alias+"_R2.fastq.gz", "0"*32)]))
+    built = time.perf_counter()
+    size = 0
+    for settag, objects in sets.items():
+        for i in range(0, len(objects), chunk_size):
+            size += len(EnaXml.write_set(settag, objects[i:i+chunk_size]).getvalue())
+    return built - start, time.perf_counter() - built, size
+
+def bench_xml(isolates=10000, chunk_size=200):
+    """Time XML building and serialization for a number of synthetic
+    isolates, then repeat under tracemalloc to find the peak memory"""
+    build, serialize, size = build_and_serialize(isolates, chunk_size)
+    tracemalloc.start()
+    build_and_serialize(isolates, chunk_size)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'isolates': isolates,
+            'build_seconds': build,
+            'serialize_seconds': serialize,
+            'xml_bytes': size,
+            'peak_memory_bytes': peak}
+
+def bench_hash(pairs, workers=None, use_mmap=False):
+    """Time hashing the fastq pairs. Returns (result, fqfile pairs)."""
+    ENAupload = enaupload()
+    size = sum(os.path.getsize(path) for pair in pairs for path in pair)
+    start = time.perf_counter()
+    files = ENAupload.hash_pairs(pairs, workers, use_mmap=use_mmap)
+    elapsed = time.perf_counter() - start
+    return {'files': 2*len(pairs),
+            'bytes': size,
+            'seconds': elapsed,
+            'mb_per_second': size/1e6/elapsed}, files
+
+def bench_upload(files, directory, connections=4, fail_rate=0.0, verbose=False):
+    """Time uploading fqfiles to a local FTP server storing them in directory"""
+    ENAupload = enaupload()
+    files = [f for pair in files for f in pair]
+    server = EnaMock.MockFtp(directory, fail_rate=fail_rate).start()
+    try:
+        start = time.perf_counter()
+        with output(verbose):
+            stats = ENAupload.upload_files(files, connections, url=server.server_address[0],
+                                           port=server.server_address[1],
+                                           user="bench", password="bench", verbose=verbose)
+        elapsed = time.perf_counter() - start
+    finally:
+        server.stop()
+    ## Resumed files only report what was sent after the failure
+    size = sum(os.path.getsize(f.path) for f in files)
+    return {'files': len(stats),
+            'connections': connections,
+            'bytes': size,
+            'seconds': elapsed,
+            'mb_per_second': size/1e6/elapsed}
+
+def bench_submit(files, export, dbname, chunk_size=200, max_inflight=4,
+                 latency=0.0, error_rate=0.0, reject_rate=0.0, retries=5, verbose=False):
+    """Time parsing the isolate export, building the object sets and
+    submitting them to a local Webin stand-in"""
+    import EnaClient
+    ENAupload = enaupload()
+    server = EnaMock.MockWebin(latency, error_rate, reject_rate).start()
+    context = ENAupload.Context(
+        user_variables={'user': "bench", 'password': "bench", 'centre_name': "SSI"},
+        client=EnaClient.SubmissionClient(server.url, ("bench", "bench"),
+                                          retries=retries, backoff=0.1),
+        dbname=dbname, url=server.url, verbose=verbose)
+    try:
+        start = time.perf_counter()
+        with open(export) as fh:
+            metadata = GetMetadata.metadata(fh, "ERC000029")
+        parsed = time.perf_counter()
+        chunking = dict(chunk_size=chunk_size, max_inflight=max_inflight)
+        sets = [ENAupload.SampleSet(context, None, **chunking),
+                ENAupload.ExperimentSet(context, "BENCH", "SSI", **chunking),
+                ENAupload.RunSet(context, "SSI", **chunking)]
+        for pair in files:
+            ENAupload.add_pair(pair, metadata, *sets)
+        built = time.perf_counter()
+        with output(verbose):
+            for objects in sets:
+                objects.drop_orphans()
+                objects.submit()
+        submitted = time.perf_counter()
+    finally:
+        server.stop()
+        context.close()
+    return {'isolates': len(files),
+            'metadata_seconds': parsed - start,
+            'build_seconds': built - parsed,
+            'submit_seconds': submitted - built,
+            'failed': sum(len(objects.failed) for objects in sets),
+            'client': context.client.stats()}
+
+def bench_db(dbname, isolates=10000):
+    """Time writing objects, accessions and digests for synthetic
+    isolates to a fresh DB the way a submission does"""
+    db = EnaSqlite.Sqlitedb(dbname)
+    aliases = ["BENCH{:06d}".format(i) for i in range(isolates)]
+    start = time.perf_counter()
+    db.add_project("BENCH")
+    db.add_samples(aliases)
+    db.add_experiments([("exp_"+alias, "BENCH", alias) for alias in aliases])
+    db.add_runs([("run_"+alias, "exp_"+alias) for alias in aliases])
+    inserted = time.perf_counter()
+    for table, prefix, accession in (("samples", "", "ERS"),
+                                     ("experiments", "exp_", "ERX"),
+                                     ("runs", "run_", "ERR")):
+        db.add_accessions([(prefix+alias, "{}{:06d}".format(accession, i))
+                           for i, alias in enumerate(aliases)], table)
+        db.add_digests([(prefix+alias, "0"*32) for alias in aliases], table)
+    db.commit()
+    written = time.perf_counter()
+    return {'isolates': isolates,
+            'insert_seconds': inserted - start,
+            'accession_seconds': written - inserted}
+
+stages = ('hash', 'upload', 'xml', 'submit', 'db')
+
+def run(args):
+    """Run the selected stages on synthetic data, returns the results"""
+    results = {'date': time.strftime("%Y-%m-%dT%H:%M:%S"),
+               'python': platform.python_version(),
+               'parameters': {k: v for k, v in vars(args).items() if k != 'output'},
+               'stages': dict()}
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        start = time.perf_counter()
+        fastqs = os.path.join(workdir, "fastqs")
+        os.mkdir(fastqs)
+        pairs = list()
+        if {'hash', 'upload', 'submit'} & set(args.stages):
+            pairs = make_fastq_pairs(fastqs, args.isolates, args.reads, args.read_length, args.seed)
+        export = os.path.join(workdir, "isolates.tsv")
+        make_isolate_export(export, args.isolates, args.seed)
+        results['generate_seconds'] = time.perf_counter() - start
+        files = None
+        if 'hash' in args.stages or pairs:
+            result, files = bench_hash(pairs, args.hash_workers, args.mmap)
+            if 'hash' in args.stages:
+                results['stages']['hash'] = result
+        if 'upload' in args.stages:
+            results['stages']['upload'] = bench_upload(
+                files, os.path.join(workdir, "ftp"), args.ftp_connections,
+                args.ftp_fail_rate, args.verbose)
+        if 'xml' in args.stages:
+            results['stages']['xml'] = bench_xml(args.xml_isolates, args.chunk_objects)
+        if 'submit' in args.stages:
+            results['stages']['submit'] = bench_submit(
+                files, export, os.path.join(workdir, "submit.sqlite"),
+                args.chunk_objects, args.max_inflight, args.latency,
+                args.error_rate, args.reject_rate, args.http_retries, args.verbose)
+        if 'db' in args.stages:
+            results['stages']['db'] = bench_db(os.path.join(workdir, "db.sqlite"),
+                                               args.xml_isolates)
+    return results
+
+def parse_arguments():
+    parser=argparse.ArgumentParser(description="Benchmark ENAupload against local stand-ins "
+                                   "for the Webin drop-box and FTP server")
+    parser.add_argument('--stages', type=lambda s: s.split(','), default=list(stages),
+                        help="Comma separated stages to run, of {}".format(",".join(stages)))
+    parser.add_argument('--isolates', type=int, default=20,
+                        help="Number of synthetic isolates with fastq pairs")
+    parser.add_argument('--reads', type=int, default=10000,
+                        help="Number of reads in each synthetic fastq")
+    parser.add_argument('--read-length', type=int, default=150)
+    parser.add_argument('--xml-isolates', type=int, default=10000,
+                        help="Number of synthetic isolates for the XML and DB stages")
+    parser.add_argument('--chunk-objects', type=int, default=200,
+                        help="Number of objects per serialized chunk")
+    parser.add_argument('--max-inflight', type=int, default=4)
+    parser.add_argument('--hash-workers', type=int, default=None)
+    parser.add_argument('--mmap', action='store_true')
+    parser.add_argument('--ftp-connections', type=int, default=4)
+    parser.add_argument('--ftp-fail-rate', type=float, default=0.0,
+                        help="Fraction of transfers the FTP server cuts off")
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help="Seconds the Webin stand-in waits before each reply")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Fraction of submissions answered with 503")
+    parser.add_argument('--reject-rate', type=float, default=0.0,
+                        help="Fraction of submissions answered with an unsuccessful receipt")
+    parser.add_argument('--http-retries', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=None,
+                        help="Where to put the synthetic data (default: system temp dir)")
+    parser.add_argument('--output', default="benchmark.json",
+                        help="JSON file for the results, - for stdout")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+    for stage in args.stages:
+        if stage not in stages:
+            parser.error("Unknown stage {}".format(stage))
+    return args
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    results = run(args)
+    if args.output == "-":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+    for stage, result in results['stages'].items():
+        print("{}: {}".format(stage, ", ".join("{}={}".format(k, round(v, 3) if isinstance(v, float) else v)
+                                                for k, v in result.items() if not isinstance(v, dict))),
+              file=sys.stderr)
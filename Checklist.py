@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import time
+import xml.etree.ElementTree as ET
+import requests
+
+checklist_url = "https://www.ebi.ac.uk/ena/browser/api/xml/{checklist}"
+
+def load_checklist(checklist, cache_dir=".", ttl=7*24*3600):
+    """Return a ChecklistValidator for an ENA checklist. The checklist XML
+    is cached in cache_dir and only downloaded again when older than ttl
+    seconds. If the download fails a stale cache file is used."""
+    path = os.path.join(cache_dir, "{}.xml".format(checklist))
+    if not os.path.exists(path) or time.time() - os.path.getmtime(path) > ttl:
+        try:
+            r = requests.get(checklist_url.format(checklist=checklist), timeout=60)
+            r.raise_for_status()
+            ET.fromstring(r.content)
+        except (requests.RequestException, ET.ParseError) as e:
+            if not os.path.exists(path):
+                raise
+            print("Could not update checklist {} ({}), using {}".format(checklist, e, path),
+                  file=sys.stderr)
+        else:
+            with open(path + ".tmp", 'wb') as fh:
+                fh.write(r.content)
+            os.replace(path + ".tmp", path)
+    return ChecklistValidator(ET.parse(path).getroot())
+
+
+class ChecklistValidator:
+    """The fields of a checklist with their regexes compiled and their
+    allowed values in sets, ready to check any number of samples"""
+    def __init__(self, checklistxml):
+        self.mandatory = list()
+        self.regexes = dict()
+        self.choices = dict()
+        for field in checklistxml.iter('FIELD'):
+            name = field.findtext('NAME')
+            if field.findtext('MANDATORY') == "mandatory":
+                self.mandatory.append(name)
+            field_type = field.find('FIELD_TYPE')
+            if field_type is None or len(field_type) == 0:
+                continue
+            if field_type[0].tag == "TEXT_FIELD":
+                regex = field_type[0].findtext('REGEX_VALUE')
+                if regex:
+                    self.regexes[name] = re.compile(regex)
+            elif field_type[0].tag == "TEXT_CHOICE_FIELD":
+                self.choices[name] = {value.text.casefold()
+                                      for value in field_type[0].iter('VALUE')
+                                      if value.text}
+
+    def check(self, sample_attributes):
+        """Return a list of every violation in one dict of sample attributes"""
+        violations = list()
+        for name in self.mandatory:
+            if not sample_attributes.get(name):
+                violations.append("{}: mandatory field missing".format(name))
+        for name, value in sample_attributes.items():
+            value = str(value)
+            regex = self.regexes.get(name)
+            if regex is not None and regex.fullmatch(value) is None:
+                violations.append("{}: \"{}\" does not match regex \"{}\"".format(
+                    name, value, regex.pattern))
+            choices = self.choices.get(name)
+            if choices is not None and value.casefold() not in choices:
+                violations.append("{}: \"{}\" is not an allowed value".format(name, value))
+        return violations
+
+    def validate(self, samples):
+        """Check {alias: sample_attributes} and return {alias: violations}
+        for the samples that have any"""
+        report = dict()
+        for alias, sample_attributes in samples.items():
+            violations = self.check(sample_attributes)
+            if violations:
+                report[alias] = violations
+        return report
@@ -8,18 +8,28 @@ import time
 import hashlib
 import argparse
 import os.path
-from ftplib import FTP
-import re
+from ftplib import FTP, error_perm, error_temp, all_errors as ftp_errors
 import json
+import sys
+import socket
+import mmap
+import asyncio
+import threading
+import queue
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import EnaSqlite
+import EnaClient
+import EnaAsync
+import Checklist
+import EnaXml
+import EnaWatch
 import GetMetadata
+import Metrics
 
 rand = random.Random()
 
-## ENA user variables
-with open("user.conf","r") as fh:
-    user_variables = json.load(fh)
 ena_checklist = "ERC000029"
 
 ## ENA url
@@ -54,23 +64,169 @@ hold="""
 
 dbname = "ena_uploader.sqlite"
 
+## Hashing defaults
+hash_chunk_size = 8*1024*1024
+
+## ENA user variables
+user_conf = "user.conf"
+
+def load_user_variables(path=user_conf):
+    """Read the Webin user, password and centre name"""
+    with open(path,"r") as fh:
+        return json.load(fh)
+
+
+class Context:
+    """Everything the submission classes share: the user variables, the
+    DB, the submission client, a factory for FTP sessions, metrics and
+    whether to be verbose. The user variables, DB and client are only
+    loaded when first used, unless they are passed in, so one context
+    can be kept for the life of a process."""
+    def __init__(self, user_variables=None, db=None, client=None, metrics=None,
+                 verbose=False, user_conf=user_conf, dbname=dbname, wal=True,
+                 url=ena_url, http_timeout=600, http_retries=5, max_inflight=4,
+                 ftp_url="webin.ebi.ac.uk", ftp_port=21):
+        self.user_conf = user_conf
+        self.dbname = dbname
+        self.wal = wal
+        self.url = url
+        self.http_timeout = http_timeout
+        self.http_retries = http_retries
+        self.max_inflight = max_inflight
+        self.ftp_url = ftp_url
+        self.ftp_port = ftp_port
+        self.metrics = metrics or Metrics.disabled
+        self.verbose = verbose
+        if user_variables is not None:
+            self.user_variables = user_variables
+        if db is not None:
+            self.db = db
+        self._client = client
+        self.lock = threading.Lock()
+        ## FTP sessions kept open between batches, see upload_files
+        self.ftp_sessions = None
+        ## IsolateIndex kept between batches
+        self.isolate_index = None
+
+    @functools.cached_property
+    def user_variables(self):
+        return load_user_variables(self.user_conf)
+
+    @functools.cached_property
+    def db(self):
+        return EnaSqlite.Sqlitedb(self.dbname, wal=self.wal, metrics=self.metrics)
+
+    @property
+    def client(self):
+        ## Usually first used by the threads posting chunks, and from
+        #  Python 3.12 on cached_property doesn't lock
+        with self.lock:
+            if self._client is None:
+                self._client = EnaClient.SubmissionClient(
+                    self.url,
+                    (self.user_variables['user'], self.user_variables['password']),
+                    timeout=(10, self.http_timeout),
+                    retries=self.http_retries,
+                    ## A connection for every post in flight
+                    pool_size=max(10, self.max_inflight),
+                    metrics=self.metrics)
+            return self._client
+
+    def ftp(self):
+        """A new, unconnected enaftp session"""
+        return enaftp(self.ftp_url, self.ftp_port,
+                      user=self.user_variables['user'],
+                      password=self.user_variables['password'],
+                      verbose=self.verbose, metrics=self.metrics)
+
+    def close_ftp_sessions(self):
+        """Log out of the FTP sessions kept open"""
+        if self.ftp_sessions is None:
+            return
+        while not self.ftp_sessions.empty():
+            try:
+                self.ftp_sessions.get().disconnect()
+            except ftp_errors:
+                pass
+        self.ftp_sessions = None
+
+    def close(self):
+        """Commit the DB and close what was opened"""
+        if 'db' in self.__dict__:
+            self.db.commit()
+        if self._client is not None:
+            self._client.close()
+        self.close_ftp_sessions()
+        self.metrics.close()
+
+
+def md5sum(path, chunk_size=hash_chunk_size, use_mmap=False):
+    """MD5 hex digest of a file, read in chunks of chunk_size bytes"""
+    m = hashlib.md5()
+    with open(path,'rb') as fh:
+        if use_mmap and os.fstat(fh.fileno()).st_size > 0:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                for offset in range(0, len(mm), chunk_size):
+                    m.update(view[offset:offset+chunk_size])
+                view.release()
+        else:
+            buf = bytearray(chunk_size)
+            view = memoryview(buf)
+            while True:
+                n = fh.readinto(buf)
+                if not n:
+                    break
+                m.update(view[:n])
+    return m.hexdigest()
+
+
+class md5reader:
+    """Read-only file wrapper that feeds every block read through it to an md5"""
+    def __init__(self, fh, md5):
+        self.fh = fh
+        self.md5 = md5
+
+    def read(self, size=-1):
+        block = self.fh.read(size)
+        self.md5.update(block)
+        return block
+
 
 class fqfile:
-    def __init__(self, path):
+    __slots__ = ('path', 'name', 'md5', 'alias')
+
+    def __init__(self, path, md5=None, chunk_size=hash_chunk_size, use_mmap=False, hash=True,
+                 metrics=Metrics.disabled):
         self.path = path
         self.name = os.path.basename(path)
-        m = hashlib.md5()
-        with open(self.path,'rb') as fh:
-            m.update(fh.read())
-        self.md5 = m.hexdigest()
+        if md5 is None and hash:
+            with metrics.timer('hash', file=self.name, bytes=os.path.getsize(path)):
+                md5 = md5sum(path, chunk_size, use_mmap)
+        self.md5 = md5
         self.alias = self.name.split('_')[0]
 
     def __str__(self):
         return "Path:{}\nName:{}\nAlias:{}\nMD5:{}".format(self.path,self.name,self.alias,self.md5)
 
 
+class Isolate:
+    """What the object sets keep of an isolate: its alias, the title, taxon
+    and attributes of its sample and its fqfiles. The XML of the sample,
+    experiment and run is only built when a chunk of them is serialized."""
+    __slots__ = ('alias', 'title', 'taxon', 'attributes', 'files')
+
+    def __init__(self, alias, title=None, taxon=None, attributes=None, files=None):
+        self.alias = alias
+        self.title = title
+        self.taxon = taxon
+        self.attributes = attributes
+        self.files = files
+
+
 class Project:
     def __init__(self,
+                 context,
                  alias="myAlias",
                  title="myTitle",
                  description="myDescription",
@@ -87,10 +243,11 @@ class Project:
            </PROJECT>
         </PROJECT_SET>
 """
+        self.context = context
         self.alias=alias
         self.releasedate = releasedate
         if accession is None:
-            accession = db.get_project_accession(alias)
+            accession = context.db.get_project_accession(alias)
         self.params = {'alias':alias,
                        'title':title,
                        'description':description,
@@ -98,271 +255,1182 @@ class Project:
         ## Decide exactly what to do about the release date
         #  All project objects are released when the project is released, but 
     def submit(self):
-        if args.verbose:
-            print("Sending to {}:".format(ena_url))
+        context = self.context
+        if context.verbose:
+            print("Sending to {}:".format(context.url))
             print(self.projectxml.format(**self.params))
         ## Create submission XML
-        submit = ET.Element('SUBMISSION')
-        actions = ET.SubElement(submit, "ACTIONS")
-        addaction = ET.SubElement(actions, "ACTION")
-        ET.SubElement(addaction, "ADD")
-        if self.releasedate is not None:
-            holdaction = ET.SubElement(actions, "ACTION")
-            ET.SubElement(holdaction, "HOLD", {'HoldUntilDate': self.releasedate})
-        r = requests.post(ena_url, files={
-            'PROJECT':io.StringIO(
-                self.projectxml.format(**self.params)),
-            'SUBMISSION':io.StringIO(
-                ET.tostring(submit, encoding="unicode"))},
-                          auth=(user_variables['user'],
-                                user_variables['password']))
-        if args.verbose:
-            print(ET.tostring(submit, encoding="unicode"))
+        submission = EnaXml.submission("ADD", self.releasedate)
+        with context.metrics.timer('submit.PROJECT', alias=self.alias) as fields:
+            self.receipt = context.client.submit({
+                'PROJECT':io.StringIO(
+                    self.projectxml.format(**self.params)),
+                'SUBMISSION':io.StringIO(submission)},
+                                                 context.verbose)
+            fields['success'] = self.receipt.success
+        if context.verbose:
+            print(submission)
             print("Received reply:")
-            print(r.text)
-        self.receipt = ET.fromstring(r.text)
-        self.success = self.receipt.get('success')=="true"
+            print(self.receipt.text)
+        self.success = self.receipt.success
+        context.metrics.outcome(self.alias, 'PROJECT', 'accepted' if self.success else 'failed',
+                                self.receipt.errors.get(self.alias))
         if self.success:
-            self.params['accession']=self.receipt.find('PROJECT').get('accession')
-            db.add_accession(self.alias, self.params['accession'],
-                             'projects')
+            self.params['accession']=self.receipt.accession(self.alias)
+            self.receipt.store(context.db)
         return self.success
     
     def cancel(self):
-        self.r = requests.post(ena_url, files={
-            'SUBMISSION':io.StringIO(submissionxml['cancel'].format(self.params))},
-                          auth=(user_variables['user'],
-                                user_variables['password']))
-        self.receipt = ET.fromstring(r.text)
-        return self.receipt.get('success')=="true"
+        context = self.context
+        self.receipt = context.client.submit({
+            'SUBMISSION':io.StringIO(
+                EnaXml.target_submission("CANCEL", [self.params['accession']]))},
+                                             context.verbose)
+        if self.receipt.success:
+            self.params['accession'] = None
+            context.db.add_project_accession(self.alias, None)
+        return self.receipt.success
 
 
-class SampleSet:
-    def __init__(self, releasedate):
-        self.et = ET.Element("SAMPLE_SET")
-        self.releasedate = releasedate
+class ChunkSubmitter:
+    """Objects of one kind, submitted in chunks of chunk_size objects with
+    at most max_inflight chunks being posted at the same time. A rejected
+    chunk is split in two and the halves resubmitted, so a bad object
+    only takes itself down. Subclasses say how a chunk is posted and what
+    is kept of an accepted one."""
+    objtag = None
+    table = None
+    ## Prefix of the object aliases
+    prefix = ""
+    ## What submit does with self.objects
+    add_action = "ADD"
 
-    def add_sample(self,alias, title, taxon_id_or_name, sample_attributes):
-        db.add_sample(alias)
-        sample = ET.SubElement(self.et,"SAMPLE",{'alias':alias})
-        sample_name = ET.SubElement(sample, "SAMPLE_NAME")
-        if type(taxon_id_or_name) is int or taxon_id_or_name.isnumeric(): 
-            sample_name.append(tv_element("TAXON_ID",str(taxon_id_or_name)))
-        else:
-            sample_name.append(tv_element("SCIENTIFIC_NAME",taxon_id_or_name))
-        sampleattributes=ET.SubElement(sample, "SAMPLE_ATTRIBUTES")
-        #self.checkmetadata(sample_attributes,ena_checklist)
-        for tag,value in sample_attributes.items():
-            sample_attribute = ET.SubElement(sampleattributes,"SAMPLE_ATTRIBUTE")
-            sample_attribute.append(tv_element("TAG",tag))
-            sample_attribute.append(tv_element("VALUE",value))
-
-    def checkmetadata(self,sample_attributes,checklist):
-        r = requests.get("https://www.ebi.ac.uk/ena/data/view/{checklist}&display=xml".format(checklist))
-        checklistxml = ET.fromstring(r.text)
-        for field in checklistxml.iterfind("FIELD"):
-            field_name = field.find('NAME').text
-            if field_name in sample_attributes.keys():
-                field_type = field.find("FIELD_TYPE")[0]
-                if field_type.tag == "TEXT_FIELD":
-                    regex = field.find('REGEX_VALUE')
-                    if regex and re.fullmatch(regex.text,sample_attributes[field_name]) is None:
-                        print("{field_name}:\"{value}\" does not match regex \"{}\"".format(field_name,sample_attributes[field_name],regex.text))
-                        return False
-                elif field_type.tag == "TEXT_CHOICE_FIELD":
-                    found = False
-                    for value in field_type.finditer("VALUE"):
-                        if value.text == sample_attributes[field_name]:
-                            found = True
-                            break
-                    if found == False:
-                        return False
+    def __init__(self, context, chunk_size=200, max_inflight=4, chunk_retries=2):
+        self.context = context
+        self.objects = list()
+        self.errors = dict()
+        self.chunk_size = chunk_size
+        self.max_inflight = max_inflight
+        self.chunk_retries = chunk_retries
+
+    def alias(self, obj):
+        raise NotImplementedError
+
+    def post_chunk(self, chunk, action):
+        """Post a list of objects and return the Receipt"""
+        raise NotImplementedError
+
+    def store_receipt(self, receipt, chunk):
+        """Keep what a receipt says about a chunk, returns True if it succeeded"""
+        raise NotImplementedError
+
+    def batches(self, add=True):
+        """(objects, action) pairs submit sends, by default self.objects
+        with add_action unless add is False"""
+        return [(self.objects, self.add_action)] if add else []
+
+    def submit(self, add=True):
+        """Submit the batches, returns True if all objects were accepted"""
+        self.receipts = list()
+        self.failed = list()
+        self.errors = dict()
+        metrics = self.context.metrics
+        batches = self.batches(add)
+        with metrics.timer('submit.' + self.objtag,
+                           objects=sum(len(objects) for objects, action in batches)) as fields:
+            for objects, action in batches:
+                self.submit_chunks(objects, action)
+            fields['failed'] = len(self.failed)
+        self.success = not self.failed
+        for alias in self.failed:
+            metrics.outcome(alias, self.objtag, 'failed', self.errors.get(alias))
+        if self.failed:
+            print("Failed to submit {} {} objects: {}".format(
+                len(self.failed), self.objtag, ", ".join(self.failed)))
+            for alias in self.failed:
+                for message in self.errors.get(alias, []):
+                    print("  {}".format(message))
+        return self.success
+
+    def submit_chunks(self, objects, action):
+        metrics = self.context.metrics
+        chunks = [(objects[i:i+self.chunk_size], 0)
+                  for i in range(0, len(objects), self.chunk_size)]
+        with ThreadPoolExecutor(max_workers=max(1, self.max_inflight)) as pool:
+            pending = {pool.submit(self.post_chunk, chunk, action): (chunk, tries)
+                       for chunk, tries in chunks}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chunk, tries = pending.pop(future)
+                    retry = list()
+                    try:
+                        receipt = future.result()
+                    except (requests.RequestException, ET.ParseError) as e:
+                        print("{} chunk of {} failed: {}".format(self.objtag, len(chunk), e))
+                        if tries < self.chunk_retries:
+                            metrics.count('retries', stage='post.' + self.objtag)
+                            retry.append((chunk, tries+1))
+                        else:
+                            self.failed.extend(self.alias(o) for o in chunk)
+                    else:
+                        self.receipts.append(receipt)
+                        if not self.store_receipt(receipt, chunk):
+                            rest = [o for o in chunk if self.alias(o) not in receipt.existing]
+                            if len(rest) < len(chunk):
+                                ## Turned down along with objects that were already added
+                                retry.append((rest, tries))
+                            elif len(chunk) > 1:
+                                metrics.count('bisections', stage='post.' + self.objtag)
+                                half = len(chunk)//2
+                                retry.extend([(chunk[:half], tries), (chunk[half:], tries)])
+                            else:
+                                self.failed.extend(self.alias(o) for o in chunk)
+                    for chunk, tries in retry:
+                        pending[pool.submit(self.post_chunk, chunk, action)] = (chunk, tries)
+
+
+class ObjectSet(ChunkSubmitter):
+    """Samples, experiments or runs, kept as Isolate records and turned
+    into XML by element when their chunk is serialized"""
+    settag = None
+    ## Prefix of the parent aliases and the table the parents are in
+    parent_prefix = None
+    parent_table = None
+
+    def __init__(self, context, **kwargs):
+        super().__init__(context, **kwargs)
+        self.modified = list()
+        self.skipped = list()
+        self.digests = dict()
+        ## Accessions of the objects to MODIFY
+        self.accessions = dict()
+        self.releasedate = None
+
+    def alias(self, isolate):
+        return self.prefix + isolate.alias
+
+    def add_isolate(self, isolate):
+        self.objects.append(isolate)
+
+    def insert(self):
+        """Add DB rows for all objects in one transaction, so their
+        accessions can be stored. Done by submit."""
+        pass
+
+    def element(self, isolate):
+        """The XML element of the object of an isolate"""
+        raise NotImplementedError
+
+    def xml(self, isolate):
+        """The element as submitted, with the accession of an object to MODIFY"""
+        element = self.element(isolate)
+        accession = self.accessions.get(self.alias(isolate))
+        if accession is not None:
+            element.set('accession', accession)
+        return element
+
+    def digest(self, obj):
+        """Digest of the XML of an object, without its accession"""
+        alias = self.alias(obj)
+        if alias not in self.digests:
+            self.digests[alias] = hashlib.md5(ET.tostring(self.element(obj))).hexdigest()
+        return self.digests[alias]
+
+    def plan(self):
+        """Compare the objects with the DB. Objects without an accession are
+        kept for ADD, those whose XML has changed since they were submitted
+        move to self.modified and the rest to self.skipped."""
+        submitted = self.context.db.get_submitted(self.table, [self.alias(o) for o in self.objects])
+        new = list()
+        for obj in self.objects:
+            accession, digest = submitted.get(self.alias(obj), (None, None))
+            if accession is None:
+                new.append(obj)
+            elif digest is not None and digest != self.digest(obj):
+                self.accessions[self.alias(obj)] = accession
+                self.modified.append(obj)
             else:
-                if field.find('MANDATORY').text == "mandatory":
-                    return False
+                self.skipped.append(obj)
+                self.context.metrics.outcome(self.alias(obj), self.objtag, 'skipped')
+        self.objects = new
 
-    def submit(self):
-        if args.verbose:
-            print("Sending to {}:".format(ena_url))
-            print(ET.tostring(self.et,encoding="unicode"))
-        submit = ET.Element('SUBMISSION')
-        actions = ET.SubElement(submit, "ACTIONS")
-        addaction = ET.SubElement(actions, "ACTION")
-        ET.SubElement(addaction, "ADD")
-        if self.releasedate is not None:
-            holdaction = ET.SubElement(actions, "ACTION")
-            ET.SubElement(holdaction, "HOLD", {'HoldUntilDate': self.releasedate})
-        r = requests.post(ena_url, files={
-            'SAMPLE':io.StringIO(ET.tostring(self.et,encoding="unicode")),
-            'SUBMISSION':io.StringIO(ET.tostring(submit,encoding="unicode"))},
-                          auth=(user_variables['user'],
-                                user_variables['password']))
-        if args.verbose:
+    def drop_orphans(self):
+        """Remove objects whose parent has no accession, as ENA would
+        reject them. Returns the aliases removed."""
+        if self.parent_prefix is None:
+            return []
+        parents = [self.parent_prefix + o.alias for o in self.objects]
+        submitted = self.context.db.get_submitted(self.parent_table, parents)
+        orphans = [self.alias(o) for o, parent in zip(self.objects, parents)
+                   if parent not in submitted]
+        for alias in orphans:
+            self.context.metrics.outcome(alias, self.objtag, 'orphaned')
+        self.objects = [o for o, parent in zip(self.objects, parents)
+                        if parent in submitted]
+        return orphans
+
+    def print_plan(self):
+        for action, objects in (("ADD", self.objects),
+                                ("MODIFY", self.modified)):
+            print("{} {}: {}".format(action, self.objtag, len(objects)))
+            for obj in objects:
+                print("  {}".format(self.alias(obj)))
+        print("SKIP {}: {}".format(self.objtag, len(self.skipped)))
+
+    def post_chunk(self, chunk, action="ADD"):
+        """Post a list of objects and return the Receipt"""
+        context = self.context
+        metrics = context.metrics
+        with metrics.timer('xml.' + self.objtag, objects=len(chunk)):
+            body = EnaXml.write_set(self.settag, map(self.xml, chunk))
+        if context.verbose:
+            print("Sending to {}:".format(context.url))
+            print(body.getvalue())
+        with metrics.timer('post.' + self.objtag, objects=len(chunk), action=action) as fields:
+            if metrics.enabled:
+                ## What is sent is the body encoded as UTF-8
+                fields['bytes'] = len(body.getvalue().encode())
+            receipt = context.client.submit({
+                self.objtag:body,
+                'SUBMISSION':io.StringIO(EnaXml.submission(action, self.releasedate))},
+                                            context.verbose)
+            fields['success'] = receipt.success
+        if context.verbose:
             print("Received reply:")
-            print(r.text)
-        self.receipt = ET.fromstring(r.text)
-        self.success = self.receipt.get('success')=="true"
-        if self.success:
-            self.samples = self.receipt.findall("SAMPLE")
-            for sample in self.samples:
-                db.add_accession(sample.get('alias'),
-                                 sample.get('accession'),
-                                 'samples')
-        return self.success
+            print(receipt.text)
+        return receipt
+
+    def store_receipt(self, receipt, chunk):
+        """Write the accessions of a successful receipt to the DB, and those
+        of objects it says were already added, e.g. by an earlier post that
+        timed out after Webin had processed it. Returns True if all objects
+        of the chunk have their accession now."""
+        ## Bisected chunks report the same errors again, keep the latest
+        self.errors.update(receipt.errors)
+        existing = [obj for obj in chunk if self.alias(obj) in receipt.existing]
+        if not receipt.success and not existing:
+            return False
+        db = self.context.db
+        metrics = self.context.metrics
+        with metrics.timer('store.' + self.objtag, objects=len(chunk)):
+            receipt.store(db)
+            db.add_accessions([(self.alias(obj), receipt.existing[self.alias(obj)])
+                               for obj in existing], self.table)
+            accepted = [obj for obj in chunk
+                        if receipt.accession(self.alias(obj)) is not None
+                        or self.alias(obj) in receipt.existing]
+            db.add_digests([(self.alias(obj), self.digest(obj)) for obj in accepted],
+                           self.table)
+        for obj in existing:
+            self.errors.pop(self.alias(obj), None)
+        for obj in accepted:
+            metrics.outcome(self.alias(obj), self.objtag, 'accepted')
+        return receipt.success or len(existing) == len(chunk)
+
+    def batches(self, add=True):
+        """New objects with ADD unless add is False, and changed ones with MODIFY"""
+        return super().batches(add) + [(self.modified, "MODIFY")]
+
+    def submit(self, add=True):
+        """Submit new objects (unless add is False) and changed ones,
+        returns True if all were accepted"""
+        if add:
+            self.insert()
+        return super().submit(add)
+
+
+class SampleSet(ObjectSet):
+    settag = "SAMPLE_SET"
+    objtag = "SAMPLE"
+    table = "samples"
 
+    def __init__(self, context, releasedate, **kwargs):
+        super().__init__(context, **kwargs)
+        self.releasedate = releasedate
+
+    def insert(self):
+        self.context.db.add_samples(isolate.alias for isolate in self.objects)
+
+    def add_sample(self,alias, title, taxon_id_or_name, sample_attributes):
+        self.add_isolate(Isolate(alias, title, taxon_id_or_name, sample_attributes))
 
-class ExperimentSet:
-    def __init__(self, project, center_name):
-        self.et = ET.Element("EXPERIMENT_SET")
+    def element(self, isolate):
+        return EnaXml.sample_element(isolate.alias, isolate.taxon, isolate.attributes)
+
+
+class ExperimentSet(ObjectSet):
+    settag = "EXPERIMENT_SET"
+    objtag = "EXPERIMENT"
+    table = "experiments"
+    prefix = "exp_"
+    parent_prefix = ""
+    parent_table = "samples"
+
+    def __init__(self, context, project, center_name, **kwargs):
+        super().__init__(context, **kwargs)
         self.project = project
         self.center_name = center_name
 
+    def insert(self):
+        self.context.db.add_experiments([(self.alias(isolate), self.project, isolate.alias)
+                                         for isolate in self.objects])
+
     def add_experiment(self,alias):
-        db.add_experiment("exp_"+alias, self.project, alias)
-        experiment = ET.SubElement(self.et, "EXPERIMENT",
-                                   {'alias': "exp_"+alias,
-                                    'center_name': self.center_name})
-        study_ref = ET.SubElement(
-            experiment, "STUDY_REF", {'refname':self.project})
-        design = ET.SubElement(experiment, "DESIGN")
-        ET.SubElement(design,"DESIGN_DESCRIPTION")
-        sample_ref = ET.SubElement(
-            design,"SAMPLE_DESCRIPTOR", {'refname':alias})
-        design.append(GetMetadata.getlibrary(alias))
-        experiment.append(GetMetadata.getplatform(alias))
-        
-    def submit(self):
-        if args.verbose:
-            print("Sending to {}:".format(ena_url))
-            print(ET.tostring(self.et,encoding="unicode"))
-        submit = ET.Element('SUBMISSION')
-        actions = ET.SubElement(submit, "ACTIONS")
-        addaction = ET.SubElement(actions, "ACTION")
-        ET.SubElement(addaction, "ADD")
-        r = requests.post(ena_url, files={
-            'EXPERIMENT':io.StringIO(ET.tostring(self.et,encoding="unicode")),
-            'SUBMISSION':io.StringIO(ET.tostring(submit,encoding="unicode"))},
-                          auth=(user_variables['user'],
-                                user_variables['password']))
-        if args.verbose:
-            print("Received reply:")
-            print(r.text)
-        self.receipt = ET.fromstring(r.text)
-        self.success = self.receipt.get('success')=="true"
-        if self.success:
-            self.experiments = self.receipt.findall("EXPERIMENT")
-            for experiment in self.experiments:
-                db.add_accession(experiment.get('alias'),
-                                 experiment.get('accession'),
-                                 'experiments')
-        return self.success
+        self.add_isolate(Isolate(alias))
+
+    def element(self, isolate):
+        return EnaXml.experiment_element(
+            self.alias(isolate), isolate.alias, self.project, self.center_name,
+            GetMetadata.library_template(), GetMetadata.platform_template())
 
-class RunSet:
-    def __init__(self, center_name):
-        self.et = ET.Element("RUN_SET")
+
+class RunSet(ObjectSet):
+    settag = "RUN_SET"
+    objtag = "RUN"
+    table = "runs"
+    prefix = "run_"
+    parent_prefix = "exp_"
+    parent_table = "experiments"
+
+    def __init__(self, context, center_name, **kwargs):
+        super().__init__(context, **kwargs)
         self.center_name = center_name
 
-    def add_run(self,alias, file_list):
-        db.add_run("run_"+alias, "exp_"+alias)
-        run = ET.SubElement(self.et, "RUN",
-                            {'alias': "run_"+alias,
-                             'center_name': self.center_name})
-        experiment_ref = ET.SubElement(
-            run, "EXPERIMENT_REF", {'refname':"exp_"+alias})
-        data_block = ET.SubElement(run,"DATA_BLOCK")
-        files = ET.SubElement(data_block,"FILES")
-        for f in file_list:
-            if args.verbose:
+    def add_isolate(self, isolate):
+        for f in isolate.files:
+            if f.md5 is None:
+                ## Prefer the digest of what was verified on upload
+                f.md5 = (self.context.db.get_upload_md5(f.name, os.path.abspath(f.path),
+                                                        os.path.getsize(f.path))
+                         or md5sum(f.path))
+        if self.context.verbose:
+            for f in isolate.files:
                 print(f)
-            ET.SubElement(files, "FILE", {'filename':"fastqs/"+f.name,
-                                          'filetype':"fastq",
-                                          'checksum_method':'MD5',
-                                          'checksum':f.md5})
-        
-    def submit(self):
-        if args.verbose:
-            print("Sending to {}:".format(ena_url))
-            print(ET.tostring(self.et,encoding="unicode"))
-        submit = ET.Element('SUBMISSION')
-        actions = ET.SubElement(submit, "ACTIONS")
-        addaction = ET.SubElement(actions, "ACTION")
-        ET.SubElement(addaction, "ADD")
-        r = requests.post(ena_url, files={
-            'RUN':io.StringIO(ET.tostring(self.et,encoding="unicode")),
-            'SUBMISSION':io.StringIO(ET.tostring(submit,encoding="unicode"))},
-                          auth=(user_variables['user'],
-                                user_variables['password']))
-        if args.verbose:
+        self.objects.append(isolate)
+
+    def add_run(self,alias, file_list):
+        self.add_isolate(Isolate(alias, files=file_list))
+
+    def insert(self):
+        self.context.db.add_runs([(self.alias(isolate), self.parent_prefix + isolate.alias)
+                                  for isolate in self.objects])
+
+    def element(self, isolate):
+        return EnaXml.run_element(
+            self.alias(isolate), self.parent_prefix + isolate.alias, self.center_name,
+            [(f.name, f.md5) for f in isolate.files])
+
+
+class CancelSet(ChunkSubmitter):
+    """Objects of a table to CANCEL, as (alias, accession) pairs. A chunk
+    is sent as one SUBMISSION with a CANCEL action per accession."""
+    add_action = "CANCEL"
+    objtags = {'samples': "SAMPLE", 'experiments': "EXPERIMENT", 'runs': "RUN"}
+
+    def __init__(self, context, table, **kwargs):
+        super().__init__(context, **kwargs)
+        self.table = table
+        self.objtag = self.objtags[table]
+
+    def alias(self, target):
+        return target[0]
+
+    def post_chunk(self, chunk, action="CANCEL"):
+        context = self.context
+        body = EnaXml.target_submission(action, [accession for alias, accession in chunk])
+        if context.verbose:
+            print("Sending to {}:".format(context.url))
+            print(body)
+        with context.metrics.timer('post.' + self.objtag, objects=len(chunk), action=action) as fields:
+            receipt = context.client.submit({'SUBMISSION':io.StringIO(body)}, context.verbose)
+            fields['success'] = receipt.success
+        if context.verbose:
             print("Received reply:")
-            print(r.text)
-        self.receipt = ET.fromstring(r.text)
-        self.success = self.receipt.get('success')=="true"
-        if self.success:
-            self.runs = self.receipt.findall("RUN")
-            for run in self.runs:
-                db.add_accession(run.get('alias'),
-                                 run.get('accession'),
-                                 'runs')
-        return self.success
+            print(receipt.text)
+        return receipt
 
+    def store_receipt(self, receipt, chunk):
+        """Forget the accessions of the objects of a successful receipt"""
+        self.errors.update(receipt.errors)
+        if not receipt.success:
+            return False
+        self.context.db.clear_accessions([alias for alias, accession in chunk], self.table)
+        for alias, accession in chunk:
+            self.context.metrics.outcome(alias, self.objtag, 'cancelled')
+        return True
 
-def tv_element(tag,value):
-    element = ET.Element(tag)
-    element.text = str(value)
-    return element
 
 class enaftp:
-    def __init__(self, url="webin.ebi.ac.uk"):
+    def __init__(self, url="webin.ebi.ac.uk", port=21, *, user, password,
+                 verbose=False, metrics=Metrics.disabled):
         self.url = url
+        self.port = port
+        self.user = user
+        self.password = password
+        self.verbose = verbose
+        self.metrics = metrics
 
     def connect(self):
-        self.ftp = FTP(self.url)
-        self.ftp.login(
-            user_variables['user'],
-            user_variables['password'])
+        self.ftp = FTP()
+        self.ftp.connect(self.url, self.port)
+        self.ftp.login(self.user, self.password)
+
+    def check(self):
+        """Reconnect if the server dropped the session, e.g. while it sat idle"""
+        try:
+            self.ftp.voidcmd('NOOP')
+        except ftp_errors:
+            self.close()
+            self.connect()
 
-    def upload(self, f):
+    def remote_size(self, name):
+        """Size of fastqs/<name> on the server, None if it isn't there"""
+        try:
+            self.ftp.voidcmd('TYPE I')
+            return self.ftp.size('fastqs/{}'.format(name))
+        except error_perm:
+            return None
+
+    def upload(self, f, db=None, blocksize=1024*1024, progress_interval=64*1024*1024):
+        """Upload a fqfile to fastqs/, returns the number of bytes sent.
+        Files already complete on the server are skipped and partial ones
+        are continued with REST. If db is given, progress is recorded in
+        it before the first block is sent, and a file on the server is
+        only skipped or continued if db shows it was sent from this file;
+        otherwise it is sent again from the start. The md5 is computed
+        from the blocks as they are sent and the size on the server is
+        checked afterwards, a mismatch raises error_temp so the upload is
+        retried. The verified md5 is set on f and kept in db."""
+        path = os.path.abspath(f.path)
+        size = os.path.getsize(path)
+        offset = self.remote_size(f.name) or 0
+        if offset > size:
+            offset = 0
+        if offset and db is not None:
+            progress = db.get_upload_progress(f.name)
+            if progress is None or tuple(progress[:2]) != (path, size):
+                ## Not ours, or sent from another file, e.g. an older version
+                print("{} on {} was not sent from {}, uploading it again".format(f.name,self.url,f.path))
+                offset = 0
+        if offset == size:
+            verified = db.get_upload_md5(f.name, path, size) if db is not None else None
+            if verified is not None and f.md5 not in (None, verified):
+                ## Same size but not what we sent, so send it again
+                print("{} on {} differs from {}, uploading it again".format(f.name,self.url,f.path))
+                offset = 0
+            else:
+                self.metrics.count('uploads_skipped')
+                if self.verbose:
+                    print("{} already on {}".format(f.name,self.url))
+                f.md5 = verified or f.md5 or md5sum(f.path)
+                if db is not None:
+                    db.set_upload_progress(f.name, path, size, size, 'done', f.md5)
+                return 0
+        sent = [offset, offset]
+        def progress(block):
+            sent[0] += len(block)
+            if db is not None and sent[0] - sent[1] >= progress_interval:
+                db.set_upload_progress(f.name, path, size, sent[0], 'partial')
+                sent[1] = sent[0]
+        if db is not None:
+            ## So what ends up on the server is known to come from this file
+            db.set_upload_progress(f.name, path, size, offset, 'partial')
+        m = hashlib.md5()
         with open(f.path,'rb') as fh:
-            if args.verbose:
-                print("uploading {} to {}".format(f.name,self.url))
-            self.ftp.storbinary('STOR fastqs/{}'.format(f.name), fh)
+            if self.verbose:
+                if offset:
+                    print("resuming {} at byte {} to {}".format(f.name,offset,self.url))
+                else:
+                    print("uploading {} to {}".format(f.name,self.url))
+            ## The part already on the server still has to be hashed
+            while fh.tell() < offset:
+                m.update(fh.read(min(blocksize, offset - fh.tell())))
+            try:
+                with self.metrics.timer('upload', file=f.name, offset=offset, bytes=size-offset):
+                    self.ftp.storbinary('STOR fastqs/{}'.format(f.name), md5reader(fh, m),
+                                        blocksize, progress, rest=offset or None)
+                    remote = self.remote_size(f.name)
+                    if sent[0] != size or remote != size:
+                        self.metrics.count('upload_mismatches')
+                        raise error_temp("{} is {} bytes on {} after sending {} of {}".format(
+                            f.name, remote, self.url, sent[0], size))
+            except ftp_errors:
+                if db is not None:
+                    db.set_upload_progress(f.name, path, size, sent[0], 'partial')
+                raise
+        md5 = m.hexdigest()
+        if f.md5 is not None and f.md5 != md5:
+            print("{} changed since it was hashed, using the md5 of what was sent".format(f.path))
+        f.md5 = md5
+        self.metrics.count('uploads_verified')
+        if db is not None:
+            db.set_upload_progress(f.name, path, size, size, 'done', md5)
+            db.add_checksum(*file_stat(path), md5)
+        return size - offset
             
     def disconnect(self):
         self.ftp.quit()
 
-def parse_fastq_list(fastq_list):
-    files = list()
+    def close(self):
+        """Drop the connection without saying goodbye, e.g. after an error"""
+        self.ftp.close()
+
+
+def upload_files(files, connections=4, db=None, retries=3, idle=None,
+                 ftp_factory=None, errors=None, **ftp_args):
+    """Upload fqfiles over a pool of concurrent enaftp sessions.
+    Files are handed out largest first, so the big ones don't end up
+    running alone at the end. A failed transfer is resumed on a fresh
+    connection up to retries times. A file that still fails raises the
+    error, unless errors is a dict: then it gets {fqfile: error} in it and
+    the other files carry on. If idle is a queue.Queue, sessions are
+    taken from it and put back afterwards instead of being logged out, so
+    they stay open between calls, and checked with NOOP before they are
+    used. New sessions come from ftp_factory, e.g. Context.ftp, or are
+    made from ftp_args.
+    Returns a list of (name, bytes, seconds)."""
+    if ftp_factory is None:
+        ftp_factory = functools.partial(enaftp, **ftp_args)
+    todo = queue.Queue()
+    for f in sorted(files, key=lambda f: os.path.getsize(f.path), reverse=True):
+        todo.put(f)
+    stats = list()
+    lock = threading.Lock()
+
+    def worker():
+        try:
+            ftp = idle.get_nowait()
+        except (AttributeError, queue.Empty):
+            ftp = ftp_factory()
+            ftp.connect()
+        else:
+            ftp.check()
+        closed = False
+        try:
+            while True:
+                try:
+                    f = todo.get_nowait()
+                except queue.Empty:
+                    break
+                start = time.perf_counter()
+                size = None
+                for attempt in range(retries+1):
+                    try:
+                        if attempt or closed:
+                            ftp.connect()
+                            closed = False
+                        size = ftp.upload(f, db)
+                        break
+                    except ftp_errors as e:
+                        ftp.close()
+                        closed = True
+                        if attempt < retries:
+                            print("Upload of {} failed ({}), resuming".format(f.name, e))
+                            ftp.metrics.count('retries', stage='upload')
+                            time.sleep(2**attempt)
+                        elif errors is None:
+                            raise
+                        else:
+                            print("Upload of {} failed ({}), giving up".format(f.name, e))
+                            with lock:
+                                errors[f] = str(e) or repr(e)
+                if size is None:
+                    continue
+                elapsed = time.perf_counter() - start
+                with lock:
+                    stats.append((f.name, size, elapsed))
+                    print("Uploaded {}: {:.1f} MB in {:.1f}s ({:.1f} MB/s)".format(
+                        f.name, size/1e6, elapsed, size/1e6/max(elapsed, 1e-9)))
+        except BaseException:
+            ftp.close()
+            raise
+        if closed:
+            ## The last file failed for good, so there is no session to keep
+            return
+        if idle is not None:
+            idle.put(ftp)
+        else:
+            try:
+                ftp.disconnect()
+            except ftp_errors:
+                pass
+
+    connections = min(connections, todo.qsize())
+    if connections < 1:
+        return stats
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=connections) as pool:
+        workers = [pool.submit(worker) for i in range(connections)]
+    for w in workers:
+        w.result()
+    elapsed = time.perf_counter() - start
+    total = sum(size for name, size, t in stats)
+    print("Uploaded {} files: {:.1f} MB in {:.1f}s ({:.1f} MB/s)".format(
+        len(stats), total/1e6, elapsed, total/1e6/max(elapsed, 1e-9)))
+    return stats
+
+def add_pair(pair, metadata, *objsets):
+    """Add the objects of a fastq pair to the sets, which all share one
+    Isolate record. Returns the Isolate."""
+    alias = pair[0].alias
+    isolate = Isolate(alias, alias, 28901, metadata.get(alias), pair)
+    for objset in objsets:
+        objset.add_isolate(isolate)
+    return isolate
+
+def _md5sum_job(job):
+    ## Returned rather than raised, so one unreadable file doesn't lose the others
+    try:
+        return md5sum(*job)
+    except OSError as e:
+        return e
+
+def file_stat(path):
+    """Absolute path, size, mtime and inode used as the checksum cache key"""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    return path, st.st_size, st.st_mtime_ns, st.st_ino
+
+def read_fastq_list(fastq_list):
+    """Return the lists of fastq paths in a fastq list, one per isolate"""
+    pairs = list()
     for line in fastq_list:
-        if line.startswith('#'):
+        if line.startswith('#') or not line.strip():
             continue
-        files.append(list(map(fqfile,line.strip().split("\t"))))
+        pairs.append(line.strip().split("\t"))
+    return pairs
+
+def hash_pairs(pairs, workers=None, chunk_size=hash_chunk_size, use_mmap=False,
+               db=None, rehash=False, hash=True, metrics=Metrics.disabled, errors=None):
+    """Turn lists of paths into lists of fqfiles, hashing all files with a
+    pool of workers processes (default: one per core). If db is given,
+    checksums of unchanged files are taken from its cache unless rehash
+    is set. With hash=False files missing from the cache are left with
+    md5=None. A file that can't be read raises its OSError, unless errors
+    is a dict: then its pair is left out and gets {alias: error} in it."""
+    md5s = dict()
+    keys = dict()
+    unreadable = dict()
+    for pair in pairs:
+        for path in pair:
+            if path in keys or path in unreadable:
+                continue
+            try:
+                keys[path] = file_stat(path)
+            except OSError as e:
+                if errors is None:
+                    raise
+                unreadable[path] = e
+                continue
+            if db is not None and not rehash:
+                md5 = db.get_checksum(*keys[path])
+                if md5 is not None:
+                    md5s[path] = md5
+    paths = [path for path in keys if path not in md5s] if hash else []
+    jobs = [(path, chunk_size, use_mmap) for path in paths]
+    metrics.count('checksum_cache_hits', len(md5s))
+    with metrics.timer('hash', files=len(paths), bytes=sum(keys[path][1] for path in paths)):
+        if workers == 1 or len(paths) < 2:
+            digests = list(map(_md5sum_job, jobs))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                digests = list(pool.map(_md5sum_job, jobs))
+    for path, md5 in zip(paths, digests):
+        if isinstance(md5, OSError):
+            if errors is None:
+                raise md5
+            unreadable[path] = md5
+            continue
+        md5s[path] = md5
+        if db is not None:
+            db.add_checksum(*keys[path], md5)
+    if db is not None and paths:
+        db.commit()
+    files = list()
+    for pair in pairs:
+        failed = [unreadable[path] for path in pair if path in unreadable]
+        if failed:
+            errors[fqfile(pair[0], hash=False).alias] = str(failed[0])
+        else:
+            files.append([fqfile(path, md5s.get(path), hash=False) for path in pair])
     return files
     
+def load_metadata(context, args, aliases):
+    if context.isolate_index is None:
+        if args.isolate_index is not None:
+            context.isolate_index = GetMetadata.IsolateIndex(args.isolate_index)
+        elif args.watch is not None:
+            ## Keep the parsed export in memory, refreshed when it changes
+            context.isolate_index = GetMetadata.IsolateIndex(":memory:")
+    with open(args.isolateinfo) as isolatefile:
+        return GetMetadata.metadata(isolatefile, ena_checklist, aliases, context.isolate_index)
+
+def check_isolates(args, metadata, aliases):
+    """Return {alias: error} of the isolates that can't be submitted: those
+    missing from the isolate export and, with --validate, those that don't
+    follow the checklist"""
+    errors = {alias: "not in the isolate export" for alias in aliases if alias not in metadata}
+    if args.validate:
+        validator = Checklist.load_checklist(ena_checklist, args.checklist_cache,
+                                             args.checklist_ttl*24*3600)
+        report = validator.validate({alias: metadata.get(alias)
+                                     for alias in aliases if alias not in errors})
+        for alias, violations in report.items():
+            errors[alias] = "; ".join(violations)
+        if report:
+            print("{} samples do not follow checklist {}".format(len(report), ena_checklist))
+    return errors
+
+def process_jobs(context, args, jobs, project_alias):
+    """Take claimed (alias, project, files, stage) jobs of one project as far
+    through the stages as they go, committing every stage as it is reached.
+    Isolates that can't be submitted get an error and are left out, the
+    others carry on."""
+    db = context.db
+    errors = dict()
+    stage = dict()
+    def leave_out(failed):
+        for alias, error in failed.items():
+            print("Leaving out {}: {}".format(alias, error))
+            if not args.dry_run:
+                db.set_job_error([alias], error)
+            stage.pop(alias, None)
+        errors.update(failed)
+    metadata = load_metadata(context, args, {job[0] for job in jobs})
+    leave_out(check_isolates(args, metadata, [job[0] for job in jobs]))
+    jobs = [job for job in jobs if job[0] not in errors]
+    if not jobs:
+        return False
+    stage.update((alias, EnaSqlite.job_stages.index(s)) for alias, p, f, s in jobs)
+    def before(name):
+        n = EnaSqlite.job_stages.index(name)
+        return [alias for alias in stage if stage[alias] < n]
+    chunking = dict(chunk_size=args.chunk_objects, max_inflight=args.max_inflight)
+    centre_name = context.user_variables['centre_name']
+    samples = SampleSet(context, args.release_date, **chunking)
+    experiments = ExperimentSet(context, project_alias, centre_name, **chunking)
+    runs = RunSet(context, centre_name, **chunking)
+    pipeline = args.pipeline and not args.no_fastq
+    ## Files that are uploaded are hashed from the blocks that are sent
+    unreadable = dict()
+    files = hash_pairs([json.loads(f) for a, p, f, s in jobs], args.hash_workers,
+                       args.hash_chunk_size, args.mmap,
+                       db, args.rehash, hash=args.no_fastq, metrics=context.metrics,
+                       errors=unreadable)
+    leave_out(unreadable)
+    if not pipeline and not args.dry_run:
+        ## Only jobs whose fastqs all have an md5, from hashing or the cache
+        hashed = {pair[0].alias for pair in files if all(f.md5 is not None for f in pair)}
+        db.set_job_stage([alias for alias in before('hashed') if alias in hashed], 'hashed')
+    def submit(objsets):
+        if not args.ignore_db:
+            for objset in objsets:
+                objset.plan()
+        if args.dry_run:
+            for objset in objsets:
+                objset.print_plan()
+            return True
+        return submit_sets(context, args, objsets, stage)
+    upload = set() if args.no_fastq else set(before('uploaded'))
+    failed_uploads = dict()
+    upload_args = ([f for pair in files if pair[0].alias in upload for f in pair],
+                   args.ftp_connections, db)
+    upload_kwargs = dict(idle=context.ftp_sessions, ftp_factory=context.ftp,
+                         errors=failed_uploads)
+    def uploaded():
+        """Leave out the isolates with a fastq that failed to upload and
+        move the others on, returns the pairs of those"""
+        leave_out({f.alias: "upload of {} failed: {}".format(f.name, error)
+                   for f, error in failed_uploads.items()})
+        db.set_job_stage([alias for alias in upload if alias not in errors], 'uploaded')
+        return [pair for pair in files if pair[0].alias not in errors]
+    if pipeline:
+        ## Samples and experiments don't need the fastqs, so they are
+        #  submitted while the fastqs are uploaded and the runs after
+        isolates = {pair[0].alias: add_pair(pair, metadata, samples, experiments)
+                    for pair in files}
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            uploading = pool.submit(upload_files, *upload_args, **upload_kwargs)
+            success = submit((samples, experiments))
+            uploading.result()
+        for pair in uploaded():
+            runs.add_isolate(isolates[pair[0].alias])
+        return submit((runs,)) and success and not errors
+    if upload:
+        upload_files(*upload_args, **upload_kwargs)
+        files = uploaded()
+    for pair in files:
+        add_pair(pair, metadata, samples, experiments, runs)
+    return submit((samples, experiments, runs)) and not errors
+
+def submit_sets(context, args, objsets, aliases):
+    """Submit object sets, given parents first, and move the jobs of
+    aliases on to the stages their accessions show they reached. The jobs
+    of rejected objects get the errors as their job error.
+    Returns True if everything was accepted."""
+    db = context.db
+    def job_errors(objset):
+        for alias in objset.failed:
+            db.set_job_error([alias[len(objset.prefix):]],
+                             "; ".join(objset.errors.get(alias) or []) or
+                             "{} not accepted".format(objset.objtag))
+    if args.use_async:
+        engine = EnaAsync.DagEngine(db, args.max_inflight, context.metrics)
+        success = asyncio.run(engine.run(*objsets))
+        print("Submitting isolates: success={}".format(success))
+        print(engine.summary())
+        for objset in objsets:
+            if objset.modified:
+                objset.submit(add=False)
+                success = success and objset.success
+                print("Modifying {}: success={}".format(objset.settag, objset.success))
+        ## Reaching a stage clears the job error, so the errors go last
+        advance_jobs(db, aliases)
+        for alias, objtag in engine.failed.items():
+            db.set_job_error([alias], "; ".join(engine.errors.get(alias) or []) or
+                             "{} not accepted".format(objtag))
+        for objset in objsets:
+            if objset.modified:
+                job_errors(objset)
+        return success
+    success = True
+    for objset in objsets:
+        orphans = objset.drop_orphans()
+        if orphans:
+            success = False
+            print("Not submitting {} {} objects without parent accession: {}".format(
+                len(orphans), objset.objtag, ", ".join(orphans)))
+        objset.submit()
+        success = success and objset.success
+        print("Submitting {}: success={}".format(objset.settag, objset.success))
+        advance_jobs(db, aliases)
+        job_errors(objset)
+    return success
+
+def advance_jobs(db, aliases):
+    """Move jobs to the last submission stage their accessions show they reached"""
+    reached = list(aliases)
+    for table, prefix, stage in (('samples', '', 'sample_submitted'),
+                                 ('experiments', 'exp_', 'experiment_submitted'),
+                                 ('runs', 'run_', 'run_submitted')):
+        submitted = db.get_submitted(table, [prefix+alias for alias in reached])
+        reached = [alias for alias in reached if prefix+alias in submitted]
+        db.set_job_stage(reached, stage)
+
+def run_jobs(context, args, batch):
+    """Work through the unfinished jobs of a batch (all batches if None),
+    claiming them so other workers sharing the DB leave them alone. Jobs
+    that failed are only retried with --resume, up to --max-attempts."""
+    db = context.db
+    metrics = context.metrics
+    success = True
+    try:
+        while True:
+            jobs = db.claim_jobs(args.worker, batch, args.claim_size, args.claim_timeout,
+                                 args.resume, args.max_attempts)
+            if not jobs:
+                break
+            projects = dict()
+            for job in jobs:
+                projects.setdefault(job[1], list()).append(job)
+            for job_project, project_jobs in projects.items():
+                try:
+                    with metrics.timer('batch', project=job_project,
+                                       isolates=len(project_jobs)) as fields:
+                        fields['success'] = process_jobs(context, args, project_jobs, job_project)
+                    success = fields['success'] and success
+                except Exception as e:
+                    db.set_job_error([job[0] for job in project_jobs], repr(e))
+                    raise
+                finally:
+                    metrics.write_prometheus()
+    finally:
+        db.release_jobs(args.worker)
+    failed = db.get_failed_jobs(batch)
+    if failed:
+        print("{} isolates have failed, --resume retries them up to --max-attempts:".format(len(failed)))
+        for alias, attempts, error in failed:
+            print("  {} ({} attempts): {}".format(alias, attempts, error))
+        success = False
+    return success
+
+def job_rows(pairs, batch, project):
+    """(alias, batch, project, files) job rows of fastq pairs"""
+    return [(fqfile(pair[0], hash=False).alias, batch, project,
+             json.dumps([os.path.abspath(path) for path in pair]))
+            for pair in pairs]
+
+def queue_pairs(db, pairs, batch, project):
+    db.add_jobs(job_rows(pairs, batch, project))
+
+def plan_jobs(context, args, jobs):
+    """Print what submitting (alias, project, files, stage) jobs would do,
+    without claiming, queueing or advancing any"""
+    projects = dict()
+    for job in jobs:
+        projects.setdefault(job[1], list()).append(job)
+    success = True
+    for job_project, project_jobs in projects.items():
+        print("Project {}:".format(job_project))
+        success = process_jobs(context, args, project_jobs, job_project) and success
+    return success
+
+def watch(context, args, path):
+    """Service mode: submit new pairs from a drop directory or fastq list
+    in micro-batches, keeping the DB, HTTP and FTP connections and the
+    isolate metadata open between batches. Pairs already queued with the
+    same files, e.g. found again after a restart, are left alone. Runs
+    until interrupted."""
+    context.ftp_sessions = queue.Queue()
+    batch = args.batch or os.path.abspath(path)
+    watcher = EnaWatch.Watcher(path, args.watch_batch_size, args.watch_window, args.watch_poll)
+    print("Watching {}".format(path))
+    try:
+        for pairs in watcher.batches():
+            rows = job_rows(pairs, batch, args.project)
+            queued = {alias: files for alias, p, files, s in
+                      context.db.get_jobs(row[0] for row in rows)}
+            rows = [row for row in rows if queued.get(row[0]) != row[3]]
+            if not rows:
+                continue
+            print("Submitting {} new isolates".format(len(rows)))
+            context.db.add_jobs(rows)
+            try:
+                ## With --resume earlier failures of the batch are retried
+                #  along with the new pairs, up to --max-attempts
+                run_jobs(context, args, batch)
+            except Exception as e:
+                print("Batch failed: {!r}".format(e))
+            context.db.commit()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        context.close_ftp_sessions()
+    return True
+
+def modify_sets(context, args, table, targets):
+    """Object sets with the current XML of the (alias, accession) targets
+    of table to MODIFY, and {alias: error} of the targets it could not be
+    built for"""
+    chunking = dict(chunk_size=args.chunk_objects, max_inflight=args.max_inflight)
+    centre_name = context.user_variables['centre_name']
+    accessions = dict(targets)
+    missing = dict()
+    if table == 'samples':
+        objset = SampleSet(context, args.release_date, **chunking)
+        metadata = load_metadata(context, args, set(accessions))
+        for alias in accessions:
+            try:
+                objset.modified.append(Isolate(alias, alias, 28901, metadata.get(alias)))
+            except KeyError:
+                missing[alias] = "not in the isolate export"
+        objsets = [objset]
+    elif table == 'experiments':
+        ## One set per project, as the project is part of the XML
+        projects = context.db.get_experiment_projects(accessions)
+        objsets = dict()
+        for alias in accessions:
+            project = projects.get(alias)
+            if project is None:
+                missing[alias] = "no project"
+                continue
+            if project not in objsets:
+                objsets[project] = ExperimentSet(context, project, centre_name, **chunking)
+            objsets[project].modified.append(Isolate(alias[len(ExperimentSet.prefix):]))
+        objsets = list(objsets.values())
+    else:
+        objset = RunSet(context, centre_name, **chunking)
+        isolates = {alias[len(RunSet.prefix):]: alias for alias in accessions}
+        jobs = dict()
+        for isolate, p, f, s in context.db.get_jobs(isolates):
+            pair = json.loads(f)
+            if all(os.path.exists(path) for path in pair):
+                jobs[isolate] = pair
+            else:
+                missing[isolates[isolate]] = "fastqs missing"
+        for isolate, alias in isolates.items():
+            if isolate not in jobs and alias not in missing:
+                missing[alias] = "fastqs unknown"
+        pairs = list(jobs.values())
+        files = hash_pairs(pairs, args.hash_workers, args.hash_chunk_size, args.mmap,
+                           context.db, args.rehash, metrics=context.metrics)
+        for isolate, pair in zip(jobs, files):
+            objset.modified.append(Isolate(isolate, files=pair))
+        objsets = [objset]
+    for objset in objsets:
+        objset.accessions = accessions
+    return objsets, missing
+
+def bulk_action(context, args, action, table):
+    """MODIFY or CANCEL the objects of table that have an accession and
+    match --where. The targets and how they fared are recorded in the
+    actions table under a batch named after the action and the time it
+    started, so running it again with --action-batch set to that name
+    only sends the ones that are not done yet. The targets of a batch are
+    fixed when it starts, --where only applies to a new one."""
+    db = context.db
+    batch = args.action_batch or "{} {} {} {}".format(
+        action, table, args.where or "all", time.strftime("%Y-%m-%dT%H:%M:%S"))
+    if db.get_action_status(batch, table):
+        targets = db.get_actions(batch, table)
+    elif args.dry_run:
+        ## What add_actions would add, without writing the batch
+        targets = db.select_submitted(table, args.where)
+    else:
+        db.add_actions(batch, action, table, db.select_submitted(table, args.where))
+        targets = db.get_actions(batch, table)
+    print("{} {} {} objects in batch \"{}\"".format(action, len(targets), table, batch))
+    if not targets:
+        return True
+    if args.dry_run:
+        for alias, accession in targets:
+            print("  {} {}".format(alias, accession))
+        return True
+    if action == "CANCEL":
+        objset = CancelSet(context, table, chunk_size=args.chunk_objects,
+                           max_inflight=args.max_inflight)
+        objset.objects = targets
+        objsets, failed = [objset], dict()
+    else:
+        objsets, failed = modify_sets(context, args, table, targets)
+    for objset in objsets:
+        objset.submit(add=action == "CANCEL")
+        for alias in objset.failed:
+            failed[alias] = "; ".join(objset.errors.get(alias, [])) or "rejected"
+    db.set_action_status(batch, table,
+                         [(alias, 'failed', failed[alias]) if alias in failed else (alias, 'done', None)
+                          for alias, accession in targets])
+    print("Batch \"{}\": {}".format(batch, ", ".join(
+        "{} {}".format(n, status) for status, n in sorted(db.count_actions(batch, table).items()))))
+    if failed:
+        print("Run again with --action-batch \"{}\" to retry the failed ones".format(batch))
+    return not failed
+
 def parse_arguments():
     parser=argparse.ArgumentParser(description="Upload to ENA")
-    parser.add_argument('fastq_list',type=argparse.FileType('r'))
-    parser.add_argument('--isolateinfo',type=argparse.FileType('r'))
+    parser.add_argument('fastq_list',type=argparse.FileType('r'),nargs='?')
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue unfinished jobs in the DB instead of reading a fastq list, also retrying failed ones")
+    parser.add_argument('--max-attempts', type=int, default=3,
+                        help="With --resume, give up on a job once it has failed this many times (0: never)")
+    parser.add_argument('--batch', type=str,
+                        help="Name of the batch of jobs (default: path of the fastq list, with --resume: all batches)")
+    parser.add_argument('--worker', type=str,
+                        default="{}:{}".format(socket.gethostname(), os.getpid()),
+                        help="Name this process claims jobs under")
+    parser.add_argument('--claim-size', type=int, default=0,
+                        help="Number of jobs claimed at a time (default: all)")
+    parser.add_argument('--claim-timeout', type=float, default=3600,
+                        help="Seconds before a job claimed by another worker may be taken over")
+    parser.add_argument('--watch', type=str,
+                        help="Keep running and submit new pairs as they appear in this drop directory or fastq list")
+    parser.add_argument('--watch-batch-size', type=int, default=50,
+                        help="Submit as soon as this many new pairs are waiting")
+    parser.add_argument('--watch-window', type=float, default=300,
+                        help="Seconds the oldest waiting pair waits before a smaller batch is submitted")
+    parser.add_argument('--watch-poll', type=float, default=10,
+                        help="Seconds between looking for new pairs")
+    parser.add_argument('--no-wal', action='store_true',
+                        help="Don't use WAL journaling, needed when the DB is on a network file system")
+    parser.add_argument('--isolateinfo', type=str,
+                        help="Isolate export the sample metadata is taken from, read again for every batch")
+    parser.add_argument('--isolate-index', type=str,
+                        help="SQLite file indexing the isolateinfo export between runs")
     parser.add_argument('--release-date',type=str)
     parser.add_argument('--new-project',action="store_true",help="Create a new project")
     parser.add_argument('-v','--verbose',action="store_true",help="Verbose output")
     parser.add_argument('--no-fastq',action='store_true', help="Don't upload fastqs")
     parser.add_argument('--project', type=str,help="Project name",
                         default = "SSI_"+str(time.localtime().tm_year))
-    return parser.parse_args()
+    parser.add_argument('--hash-workers', type=int, default=None,
+                        help="Number of processes used for hashing fastqs (default: number of cores)")
+    parser.add_argument('--hash-chunk-size', type=int, default=hash_chunk_size,
+                        help="Read size in bytes when hashing fastqs")
+    parser.add_argument('--mmap', action='store_true',
+                        help="Memory map fastqs when hashing")
+    parser.add_argument('--rehash', action='store_true',
+                        help="Ignore cached checksums and hash all fastqs again")
+    parser.add_argument('--ftp-connections', type=int, default=4,
+                        help="Number of concurrent FTP sessions used for uploading")
+    parser.add_argument('--http-timeout', type=float, default=600,
+                        help="Seconds to wait for a reply from the submission server")
+    parser.add_argument('--http-retries', type=int, default=5,
+                        help="Number of times a failed submission is retried")
+    parser.add_argument('--chunk-objects', type=int, default=200,
+                        help="Number of samples, experiments or runs sent per submission")
+    parser.add_argument('--max-inflight', type=int, default=4,
+                        help="Number of submissions sent at the same time")
+    parser.add_argument('--validate', action='store_true',
+                        help="Check the sample metadata against the ENA checklist before submitting")
+    parser.add_argument('--checklist-cache', type=str, default=".",
+                        help="Directory where the checklist XML is cached")
+    parser.add_argument('--checklist-ttl', type=float, default=7,
+                        help="Days before the cached checklist is downloaded again")
+    parser.add_argument('--ignore-db', action='store_true',
+                        help="Submit every object, also those that already have an accession")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Print what would be submitted and exit")
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="Submit each isolate's sample, experiment and run as soon as its parent is accepted")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="Submit samples and experiments while the fastqs are uploaded, and the runs once they are up")
+    parser.add_argument('--modify', choices=('samples', 'experiments', 'runs'),
+                        help="Send the current XML of the objects of this table matching --where as MODIFY")
+    parser.add_argument('--cancel', choices=('samples', 'experiments', 'runs'),
+                        help="CANCEL the objects of this table matching --where")
+    parser.add_argument('--where', type=str,
+                        help="SQL condition on the table selecting the objects for --modify or --cancel (default: all with an accession)")
+    parser.add_argument('--action-batch', type=str,
+                        help="Name the progress of --modify or --cancel is tracked under, give the name of an earlier batch to continue it with the objects it started with (default: from the action, table, condition and time)")
+    parser.add_argument('--metrics-log', type=str,
+                        help="Append stage timings and per-isolate outcomes to this file as JSON lines")
+    parser.add_argument('--metrics-file', type=str,
+                        help="Write metrics in the Prometheus text format to this file after every batch")
+    parser.add_argument('--metrics-port', type=int,
+                        help="Serve metrics in the Prometheus text format on this port at /metrics")
+    args = parser.parse_args()
+    bulk = args.modify is not None or args.cancel is not None
+    if args.modify is not None and args.cancel is not None:
+        parser.error("--modify and --cancel can't be combined")
+    if bulk and args.fastq_list is not None:
+        parser.error("--modify and --cancel don't take a fastq_list")
+    if args.dry_run and args.watch is not None:
+        parser.error("--dry-run can't be combined with --watch")
+    if args.fastq_list is None and not args.resume and args.watch is None and not bulk:
+        parser.error("a fastq_list is needed unless --resume, --watch, --modify or --cancel is given")
+    ## Everything but --modify of experiments or runs and --cancel submits samples
+    if args.isolateinfo is None and (not bulk or args.modify == 'samples'):
+        parser.error("--isolateinfo is needed to submit samples")
+    if args.isolateinfo is not None and not os.path.isfile(args.isolateinfo):
+        parser.error("--isolateinfo {} is not a file".format(args.isolateinfo))
+    return args
 
 if __name__ == "__main__":
 
     args = parse_arguments()
+
+    metrics = None
+    if args.metrics_log or args.metrics_file or args.metrics_port:
+        metrics = Metrics.Metrics(args.metrics_log, args.metrics_file)
+        if args.metrics_port:
+            metrics.serve(args.metrics_port)
+    context = Context(metrics=metrics, verbose=args.verbose, wal=not args.no_wal,
+                      http_timeout=args.http_timeout, http_retries=args.http_retries,
+                      max_inflight=args.max_inflight)
     
     ## Create DB
-    db = EnaSqlite.Sqlitedb(dbname)
+    db = context.db
     project_alias = args.project
-    db.add_project(project_alias)
+    if not args.dry_run:
+        db.add_project(project_alias)
     
     ## While running in dev mode we don't trust the DB, since everything disappears after 24h
     ## Create a study
-    project = Project(project_alias)
-    if args.new_project:
+    project = Project(context, project_alias)
+    if args.new_project and args.dry_run:
+        print("Would submit project {}".format(project_alias))
+    elif args.new_project:
         if project.submit():
             db.add_project_accession(project.params['alias'], project.params['accession'])
         else:
@@ -371,32 +1439,40 @@ if __name__ == "__main__":
                     project.params))
             except KeyError:
                 print("Project submission failed and no accession available in db")
-                print(ET.tostring(project.receipt).decode())
-
-    ## Submit samples
-    samples = SampleSet(args.release_date)
-    experiments = ExperimentSet(project.alias, user_variables['centre_name'])
-    runs = RunSet(user_variables['centre_name'])
-    files = parse_fastq_list(args.fastq_list)
-    metadata = GetMetadata.metadata(args.isolateinfo, ena_checklist)
-    if not args.no_fastq:
-        ftp = enaftp()
-        ftp.connect()
-        for pair in files:
-            for f in pair:
-                ftp.upload(f)
-        ftp.disconnect()
-    for pair in files:
-        alias = pair[0].alias
-        samples.add_sample(alias,
-                           alias,
-                           28901,
-                           metadata.get(alias))
-        experiments.add_experiment(alias)
-        runs.add_run(alias,pair)
-    print("Submitting samples: success={}".format(samples.submit()))
-    print("Submitting experiments: success={}".format(experiments.submit()))
-    print("Submitting runs: success={}".format(runs.submit()))
-
-    db.commit()
+                for messages in project.receipt.errors.values():
+                    print("\n".join(messages))
+
+    ## Queue the isolates of the fastq list as jobs
+    batch = args.batch
+    pairs = None
+    if args.fastq_list is not None:
+        if batch is None:
+            batch = os.path.abspath(args.fastq_list.name)
+        pairs = read_fastq_list(args.fastq_list)
+    if args.dry_run:
+        args.no_fastq = True
+
+    if args.cancel is not None:
+        success = bulk_action(context, args, "CANCEL", args.cancel)
+    elif args.modify is not None:
+        success = bulk_action(context, args, "MODIFY", args.modify)
+    elif args.watch is not None:
+        success = watch(context, args, args.watch)
+    elif args.dry_run:
+        ## Plan from the fastq list or the unfinished jobs, leaving the DB alone
+        if pairs is not None:
+            jobs = [(alias, p, files, 'queued') for alias, b, p, files in job_rows(pairs, batch, args.project)]
+        else:
+            jobs = db.get_unfinished_jobs(batch)
+        success = plan_jobs(context, args, jobs)
+    else:
+        if pairs is not None:
+            queue_pairs(db, pairs, batch, args.project)
+        success = run_jobs(context, args, batch)
+    print("Submission requests: {requests}, retries: {retries}, mean latency: {mean_latency:.2f}s, max latency: {max_latency:.2f}s".format(
+        **context.client.stats()))
+
+    context.close()
+    if not success:
+        sys.exit(1)
     
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import asyncio
+import time
+import statistics
+
+import Metrics
+
+class DagEngine:
+    """Submit samples, experiments and runs per isolate rather than per set.
+
+    Every isolate is its own asyncio task walking the chain
+    sample -> experiment -> run, and each object is posted as soon as its
+    parent has an accession in the DB. At most concurrency posts are in
+    flight overall. The posts themselves go through ObjectSet.post_chunk
+    in worker threads, so they share the pooled submission client."""
+
+    def __init__(self, db, concurrency=8, metrics=None):
+        self.db = db
+        self.metrics = metrics or Metrics.disabled
+        self.concurrency = concurrency
+        self.latencies = dict()
+        ## {isolate alias: objtag} of the object that failed, and its errors
+        self.failed = dict()
+        self.errors = dict()
+
+    async def submit_object(self, objset, obj):
+        """Post a single object and store its accession, returns success"""
+        async with self.semaphore:
+            try:
+                receipt = await asyncio.to_thread(objset.post_chunk, [obj])
+            except Exception as e:
+                print("{} {} failed: {}".format(objset.objtag, objset.alias(obj), e))
+                return False
+        if not objset.store_receipt(receipt, [obj]):
+            return False
+        return self.db.get_accession(objset.alias(obj), objset.table) is not None
+
+    async def submit_isolate(self, alias, chain):
+        start = time.perf_counter()
+        for objset, obj in chain:
+            if not await self.submit_object(objset, obj):
+                self.failed[alias] = objset.objtag
+                self.errors[alias] = objset.errors.get(objset.alias(obj))
+                self.metrics.outcome(objset.alias(obj), objset.objtag, 'failed',
+                                     self.errors[alias])
+                return
+        self.latencies[alias] = time.perf_counter() - start
+        self.metrics.observe('isolate', self.latencies[alias], alias=alias)
+
+    def chains(self, *objsets):
+        """Chain the objects of every isolate across the sets, which are
+        given parents first. Objects whose parent is not in the sets
+        (because it was submitted earlier) start a chain of their own."""
+        chains = dict()
+        for objset in objsets:
+            for obj in objset.objects:
+                chains.setdefault(obj.alias, list()).append((objset, obj))
+        return chains.items()
+
+    async def run(self, *objsets):
+        """Submit everything in the sets, given parents first, returns True
+        if every isolate got through"""
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        for objset in objsets:
+            objset.insert()
+        await asyncio.gather(*(self.submit_isolate(alias, chain)
+                               for alias, chain in self.chains(*objsets)))
+        return not self.failed
+
+    def summary(self):
+        latencies = sorted(self.latencies.values())
+        if not latencies:
+            return "Submitted 0 isolates, {} failed".format(len(self.failed))
+        return "Submitted {} isolates, {} failed, latency median {:.2f}s, max {:.2f}s".format(
+            len(latencies), len(self.failed), statistics.median(latencies), latencies[-1])
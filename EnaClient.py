@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+import io
+import re
+import time
+import threading
+import xml.etree.ElementTree as ET
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+import Metrics
+
+def not_sent(e):
+    """Whether a failed request certainly never reached the server"""
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+class SubmissionClient:
+    """Client for the Webin drop-box, sharing one pooled keep-alive session
+    between all submissions and retrying with exponential backoff. A
+    submission can't be undone, so only requests that were certainly not
+    processed are retried: those that couldn't connect and those turned
+    away with 429 or 503. Other errors are raised."""
+    retry_status = (429, 503)
+
+    def __init__(self, url, auth, timeout=(10, 600), retries=5, backoff=1.0, pool_size=10,
+                 metrics=None):
+        self.url = url
+        self.metrics = metrics or Metrics.disabled
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        self.session.auth = auth
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        ## Statistics
+        self.lock = threading.Lock()
+        self.latencies = list()
+        self.retry_count = 0
+
+    def post(self, files, stream=False):
+        """POST a multipart submission and return the response"""
+        for attempt in range(self.retries+1):
+            ## File objects are consumed by a failed attempt
+            for f in files.values():
+                if hasattr(f, 'seek'):
+                    f.seek(0)
+            start = time.perf_counter()
+            try:
+                r = self.session.post(self.url, files=files, timeout=self.timeout,
+                                      stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.metrics.observe('http.post', time.perf_counter() - start, error=repr(e))
+                if attempt == self.retries or not not_sent(e):
+                    raise
+            else:
+                latency = time.perf_counter() - start
+                with self.lock:
+                    self.latencies.append(latency)
+                self.metrics.observe('http.post', latency, status=r.status_code)
+                if r.status_code not in self.retry_status or attempt == self.retries:
+                    r.raise_for_status()
+                    return r
+            with self.lock:
+                self.retry_count += 1
+            self.metrics.count('retries', stage='http.post')
+            time.sleep(self.backoff * 2**attempt)
+
+    def submit(self, files, keep_text=False):
+        """POST a submission and parse the receipt as it streams in.
+        With keep_text the reply is buffered and kept as receipt.text."""
+        r = self.post(files, stream=not keep_text)
+        try:
+            if keep_text:
+                receipt = parse_receipt(io.BytesIO(r.content))
+                receipt.text = r.text
+            else:
+                r.raw.decode_content = True
+                receipt = parse_receipt(r.raw)
+        finally:
+            r.close()
+        return receipt
+
+    def stats(self):
+        """Number of requests, retries and mean and max latency in seconds"""
+        with self.lock:
+            n = len(self.latencies)
+            return {'requests': n,
+                    'retries': self.retry_count,
+                    'mean_latency': sum(self.latencies)/n if n else 0.0,
+                    'max_latency': max(self.latencies, default=0.0)}
+
+    def close(self):
+        self.session.close()
+
+
+class Receipt:
+    """The parts of a Webin receipt we use: whether it succeeded, the
+    (alias, accession, table) of every object, the ERROR and INFO
+    messages by the alias they mention (None if they mention none) and
+    {alias: accession} of objects rejected because they already exist"""
+    tables = {'PROJECT': 'projects',
+              'SAMPLE': 'samples',
+              'EXPERIMENT': 'experiments',
+              'RUN': 'runs'}
+
+    def __init__(self):
+        self.success = False
+        self.accessions = list()
+        self.errors = dict()
+        self.infos = dict()
+        self.existing = dict()
+        self.text = None
+
+    def accession(self, alias):
+        for a, accession, table in self.accessions:
+            if a == alias:
+                return accession
+        return None
+
+    def store(self, db):
+        """Write all accessions to the DB in one transaction"""
+        db.add_accessions(self.accessions)
+
+
+message_alias = re.compile(r'alias:\s*"([^"]*)"')
+## Webin's answer to adding an object again, e.g. after a post timed out
+#  that had been processed
+message_existing = re.compile(r'already exists in the submission account with accession:\s*"([^"]+)"')
+
+def parse_receipt(source):
+    """Parse a receipt from a file-like object with iterparse, clearing
+    each object once read so large receipts stay small in memory"""
+    receipt = Receipt()
+    depth = 0
+    for event, element in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 1:
+                receipt.success = element.get('success') == "true"
+            continue
+        depth -= 1
+        if element.tag in Receipt.tables and depth == 1:
+            if element.get('accession'):
+                receipt.accessions.append((element.get('alias'),
+                                           element.get('accession'),
+                                           Receipt.tables[element.tag]))
+            element.clear()
+        elif element.tag in ('ERROR', 'INFO'):
+            messages = receipt.errors if element.tag == 'ERROR' else receipt.infos
+            text = (element.text or '').strip()
+            m = message_alias.search(text)
+            messages.setdefault(m.group(1) if m else None, list()).append(text)
+            existing = message_existing.search(text)
+            if m and existing and element.tag == 'ERROR':
+                receipt.existing[m.group(1)] = existing.group(1)
+    return receipt
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+import os
+import random
+import socket
+import socketserver
+import threading
+import time
+import itertools
+import email.parser
+import email.policy
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+## Local stand-ins for the Webin drop-box and FTP server, for benchmarks
+#  and for trying things out without sending anything to EBI.
+
+accession_prefixes = {'PROJECT': 'PRJEB',
+                      'SAMPLE': 'ERS',
+                      'EXPERIMENT': 'ERX',
+                      'RUN': 'ERR'}
+
+
+class WebinHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if server.latency:
+            time.sleep(server.latency)
+        if server.rand.random() < server.error_rate:
+            self.send_error(503, "Mock service unavailable")
+            return
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b"Content-Type: " + self.headers['Content-Type'].encode() + b"\r\n\r\n" + body)
+        parts = {part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+                 for part in message.iter_parts()}
+        receipt = ET.Element('RECEIPT', {'receiptDate': time.strftime("%Y-%m-%dT%H:%M:%S"),
+                                         'submissionFile': 'SUBMISSION',
+                                         'success': 'true'})
+        messages = ET.Element('MESSAGES')
+        reject = server.rand.random() < server.reject_rate
+        with server.lock:
+            objects = [obj for name, payload in parts.items() if name != 'SUBMISSION'
+                       for obj in ET.fromstring(payload)]
+            ## Objects added again, rather than modified by accession
+            existing = dict()
+            for obj in objects:
+                accession = server.added.get((obj.tag, obj.get('alias')))
+                if accession is not None and obj.get('accession') is None:
+                    existing[obj.get('alias')] = accession
+            reject = reject or bool(existing)
+            for obj in objects:
+                alias = obj.get('alias')
+                attributes = {'alias': alias, 'status': 'PRIVATE'}
+                if alias in existing:
+                    ET.SubElement(messages, 'ERROR').text = (
+                        'In {}, alias:"{}", accession:"". The object being added already exists '
+                        'in the submission account with accession: "{}".'.format(
+                            obj.tag.lower(), alias, existing[alias]))
+                elif reject and not existing:
+                    ET.SubElement(messages, 'ERROR').text = \
+                        'In {}, alias:"{}", accession:"". Mock rejection.'.format(obj.tag.lower(), alias)
+                elif not reject:
+                    attributes['accession'] = obj.get('accession') or "{}{:06d}".format(
+                        accession_prefixes.get(obj.tag, 'ERZ'), next(server.counter))
+                    server.added.setdefault((obj.tag, alias), attributes['accession'])
+                ET.SubElement(receipt, obj.tag, attributes)
+        if reject:
+            receipt.set('success', 'false')
+        ET.SubElement(receipt, 'SUBMISSION', {'accession': "ERA{:06d}".format(next(server.counter)),
+                                              'alias': 'SUBMISSION'})
+        ET.SubElement(messages, 'INFO').text = "This submission is a TEST submission and will be discarded within 24 hours"
+        receipt.append(messages)
+        reply = ET.tostring(receipt, encoding='utf-8')
+        if server.rand.random() < server.drop_rate:
+            ## Processed, but the client never hears about it
+            self.close_connection = True
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+
+class MockWebin(ThreadingHTTPServer):
+    """Webin drop-box stand-in answering submissions with receipts. Every
+    reply is delayed by latency seconds, a fraction error_rate of requests
+    fail with 503 and a fraction reject_rate get a success="false" receipt.
+    A fraction drop_rate are processed but the connection is closed
+    instead of replying. Adding an alias a second time is rejected with
+    the accession it already has, as Webin does."""
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, error_rate=0.0, reject_rate=0.0, seed=None, port=0,
+                 drop_rate=0.0):
+        super().__init__(('127.0.0.1', port), WebinHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.reject_rate = reject_rate
+        self.drop_rate = drop_rate
+        ## {(tag, alias): accession} of the objects added
+        self.added = dict()
+        self.lock = threading.Lock()
+        self.rand = random.Random(seed)
+        self.counter = itertools.count(1)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/ena/submit/drop-box/submit/".format(self.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FtpHandler(socketserver.StreamRequestHandler):
+    def reply(self, text):
+        self.wfile.write((text + "\r\n").encode())
+
+    def path(self, name):
+        path = os.path.normpath(os.path.join(self.server.root, name.lstrip('/')))
+        if not path.startswith(self.server.root):
+            raise ValueError(name)
+        return path
+
+    def handle(self):
+        self.reply("220 Mock ENA FTP")
+        rest = 0
+        listener = None
+        for line in self.rfile:
+            cmd, _, arg = line.decode().strip().partition(' ')
+            cmd = cmd.upper()
+            if cmd == 'USER':
+                self.reply("331 Password required")
+            elif cmd == 'PASS':
+                self.reply("230 Logged in")
+            elif cmd == 'TYPE':
+                self.reply("200 Type set")
+            elif cmd == 'NOOP':
+                self.reply("200 NOOP ok")
+            elif cmd == 'SIZE':
+                try:
+                    self.reply("213 {}".format(os.path.getsize(self.path(arg))))
+                except (OSError, ValueError):
+                    self.reply("550 No such file")
+            elif cmd == 'REST':
+                rest = int(arg)
+                self.reply("350 Restarting at {}".format(rest))
+            elif cmd in ('PASV', 'EPSV'):
+                if listener is not None:
+                    listener.close()
+                listener = socket.socket()
+                listener.bind((self.server.server_address[0], 0))
+                listener.listen(1)
+                port = listener.getsockname()[1]
+                if cmd == 'PASV':
+                    host = self.server.server_address[0].replace('.', ',')
+                    self.reply("227 Entering Passive Mode ({},{},{})".format(host, port >> 8, port & 255))
+                else:
+                    self.reply("229 Entering Extended Passive Mode (|||{}|)".format(port))
+            elif cmd == 'STOR' and listener is not None:
+                try:
+                    path = self.path(arg)
+                except ValueError:
+                    self.reply("553 Bad file name")
+                    continue
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                self.reply("150 Ok to send data")
+                data, _ = listener.accept()
+                listener.close()
+                listener = None
+                fail = self.server.rand.random() < self.server.fail_rate
+                with data, open(path, 'r+b' if rest and os.path.exists(path) else 'wb') as fh:
+                    fh.seek(rest)
+                    fh.truncate()
+                    received = 0
+                    while True:
+                        block = data.recv(1024*1024)
+                        if not block:
+                            break
+                        fh.write(block)
+                        received += len(block)
+                        if fail and received:
+                            break
+                rest = 0
+                if fail:
+                    self.reply("426 Connection closed; transfer aborted")
+                else:
+                    self.reply("226 Transfer complete")
+            elif cmd == 'QUIT':
+                self.reply("221 Goodbye")
+                break
+            else:
+                self.reply("502 Command not implemented")
+        if listener is not None:
+            listener.close()
+
+
+class MockFtp(socketserver.ThreadingTCPServer):
+    """Minimal FTP server storing uploads under root. It knows just what
+    enaftp uses: login, TYPE, NOOP, SIZE, REST, PASV/EPSV and STOR. A
+    fraction fail_rate of transfers are cut off after the first block."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root, fail_rate=0.0, seed=None, port=0):
+        super().__init__(('127.0.0.1', port), FtpHandler)
+        self.root = os.path.abspath(root)
+        self.fail_rate = fail_rate
+        self.rand = random.Random(seed)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
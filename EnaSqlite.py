@@ -1,69 +1,446 @@
 #!/usr/bin/env python3
 
 import sqlite3
+import threading
+import time
+
+import Metrics
+
+## Version of the schema created by create_tables, stored in PRAGMA user_version
+schema_version = 3
+
+## Stages an isolate job goes through, in order
+job_stages = ('queued', 'hashed', 'uploaded',
+              'sample_submitted', 'experiment_submitted', 'run_submitted')
 
 class Sqlitedb:
-    def __init__(self, dbname):
-        self.connection = sqlite3.connect(dbname)
+    def __init__(self, dbname, wal=True, metrics=None):
+        ## The connection is shared with the upload threads, all access
+        #  to the cursor goes through self.lock. Other worker processes
+        #  may hold the write lock for a while, hence the long timeout.
+        #  WAL needs shared memory, so turn it off when the DB is shared
+        #  between hosts on a network file system.
+        self.connection = sqlite3.connect(dbname, timeout=60, check_same_thread=False)
         self.c = self.connection.cursor()
+        self.lock = threading.RLock()
+        self.metrics = metrics or Metrics.disabled
+        if wal:
+            ## Readers don't block the writer, and a commit is an append to the log
+            self.c.execute('PRAGMA journal_mode=WAL;')
+            self.c.execute('PRAGMA synchronous=NORMAL;')
         self.create_tables()
+        self.migrate()
 
     def create_project_table(self):
         """Create the projects table"""
         self.c.execute('CREATE TABLE IF NOT EXISTS projects (id INTEGER PRIMARY KEY, alias TEXT unique, accession TEXT unique);')
 
     def add_project(self, alias):
-        self.c.execute("insert or ignore into projects (alias) VALUES (?);",(alias,))
+        with self.lock:
+            self.c.execute("insert or ignore into projects (alias) VALUES (?);",(alias,))
         
     def add_project_accession(self, alias, accession):
-        self.c.execute("update projects set accession=? where alias=?;", (accession, alias))
+        with self.lock:
+            self.c.execute("update projects set accession=? where alias=?;", (accession, alias))
 
     def get_project_accession(self, alias):
-        self.c.execute("select accession from projects where alias=?;",(alias,))
-        return self.c.fetchone()[0]
+        with self.lock:
+            self.c.execute("select accession from projects where alias=?;",(alias,))
+            row = self.c.fetchone()
+            return row[0] if row else None
     
+    @Metrics.timed("db.add_sample")
     def add_sample(self, alias):
-        self.c.execute("insert or ignore into samples (alias) VALUES (?);",(alias,))
+        with self.lock:
+            self.c.execute("insert or ignore into samples (alias) VALUES (?);",(alias,))
 
+    @Metrics.timed("db.add_experiment")
     def add_experiment(self, alias, project_alias, sample_alias):
-        self.c.execute("insert or ignore into experiments (alias, project_id, sample_id) VALUES (?,(SELECT id FROM projects WHERE alias=?),(SELECT id FROM samples WHERE alias=?));",(alias, project_alias, sample_alias))
+        with self.lock:
+            self.c.execute("insert or ignore into experiments (alias, project_id, sample_id) VALUES (?,(SELECT id FROM projects WHERE alias=?),(SELECT id FROM samples WHERE alias=?));",(alias, project_alias, sample_alias))
 
+    @Metrics.timed("db.add_run")
     def add_run(self, alias, experiment_alias):
-        self.c.execute("insert or ignore into runs (alias, experiment_id) VALUES (?,(SELECT id FROM experiments WHERE alias=?));",(alias, experiment_alias))
+        with self.lock:
+            self.c.execute("insert or ignore into runs (alias, experiment_id) VALUES (?,(SELECT id FROM experiments WHERE alias=?));",(alias, experiment_alias))
+
+    @Metrics.timed("db.add_samples")
+    def add_samples(self, aliases):
+        """Insert many samples in one transaction"""
+        with self.lock, self.connection:
+            self.c.executemany("insert or ignore into samples (alias) VALUES (?);",
+                               ((alias,) for alias in aliases))
+
+    @Metrics.timed("db.add_experiments")
+    def add_experiments(self, rows):
+        """Insert many (alias, project_alias, sample_alias) experiments in one transaction"""
+        with self.lock, self.connection:
+            self.c.executemany("insert or ignore into experiments (alias, project_id, sample_id) VALUES (?,(SELECT id FROM projects WHERE alias=?),(SELECT id FROM samples WHERE alias=?));", rows)
+
+    @Metrics.timed("db.add_runs")
+    def add_runs(self, rows):
+        """Insert many (alias, experiment_alias) runs in one transaction"""
+        with self.lock, self.connection:
+            self.c.executemany("insert or ignore into runs (alias, experiment_id) VALUES (?,(SELECT id FROM experiments WHERE alias=?));", rows)
+
+    @Metrics.timed("db.add_accessions")
+    def add_accessions(self, rows, table=None):
+        """Set the accession of many (alias, accession) rows in one
+        transaction, or of (alias, accession, table) rows if table is None"""
+        if table is None:
+            tables = dict()
+            for alias, accession, t in rows:
+                tables.setdefault(t, list()).append((accession, alias))
+        else:
+            tables = {table: [(accession, alias) for alias, accession in rows]}
+        with self.lock, self.connection:
+            for table, updates in tables.items():
+                self.c.executemany("update " + table + " set accession=? where alias=?;", updates)
+
+    @Metrics.timed("db.add_digests")
+    def add_digests(self, rows, table):
+        """Set the digest of many (alias, digest) rows in one transaction"""
+        with self.lock, self.connection:
+            self.c.executemany("update " + table + " set digest=? where alias=?;",
+                               ((digest, alias) for alias, digest in rows))
 
     def add_accession(self, alias, accession, table):
-        self.c.execute("update " + table + " set accession=? where alias=?;", (accession, alias))
+        with self.lock:
+            self.c.execute("update " + table + " set accession=? where alias=?;", (accession, alias))
 
     def get_accession(self, alias, table):
-        self.c.execute("select accession from " + table + " where alias=?;", (alias, ))
-        return self.c.fetchone()[0]
+        with self.lock:
+            self.c.execute("select accession from " + table + " where alias=?;", (alias, ))
+            return self.c.fetchone()[0]
+
+    def add_digest(self, alias, digest, table):
+        """Record the digest of the XML last submitted for an object"""
+        with self.lock:
+            self.c.execute("update " + table + " set digest=? where alias=?;", (digest, alias))
+
+    @Metrics.timed("db.get_submitted")
+    def get_submitted(self, table, aliases):
+        """Return {alias: (accession, digest)} for the aliases that have an accession"""
+        aliases = list(aliases)
+        submitted = dict()
+        with self.lock:
+            for i in range(0, len(aliases), 500):
+                batch = aliases[i:i+500]
+                self.c.execute("select alias, accession, digest from " + table +
+                               " where accession is not null and alias in (" +
+                               ",".join("?"*len(batch)) + ");", batch)
+                for alias, accession, digest in self.c.fetchall():
+                    submitted[alias] = (accession, digest)
+        return submitted
+
+    @Metrics.timed("db.select_submitted")
+    def select_submitted(self, table, where=None, params=()):
+        """Return (alias, accession) of the objects in table that have an
+        accession and match the SQL condition where"""
+        query = "select alias, accession from " + table + " where accession is not null"
+        if where:
+            query += " and (" + where + ")"
+        with self.lock:
+            self.c.execute(query + " order by id;", params)
+            return self.c.fetchall()
+
+    def clear_accessions(self, aliases, table):
+        """Forget the accession and digest of cancelled objects"""
+        with self.lock, self.connection:
+            self.c.executemany("update " + table + " set accession=null, digest=null where alias=?;",
+                               ((alias,) for alias in aliases))
+
+    def get_experiment_projects(self, aliases):
+        """Return {alias: project alias} of experiments"""
+        aliases = list(aliases)
+        projects = dict()
+        with self.lock:
+            for i in range(0, len(aliases), 500):
+                batch = aliases[i:i+500]
+                self.c.execute("select e.alias, p.alias from experiments e join projects p on p.id=e.project_id "
+                               "where e.alias in (" + ",".join("?"*len(batch)) + ");", batch)
+                projects.update(self.c.fetchall())
+        return projects
+
+    def add_column(self, table, column, coltype):
+        """Add a column to an existing table unless it is already there"""
+        self.c.execute("PRAGMA table_info(" + table + ");")
+        if column not in [row[1] for row in self.c.fetchall()]:
+            self.c.execute("ALTER TABLE " + table + " ADD COLUMN " + column + " " + coltype + ";")
 
     def create_sample_table(self):
         """Create the samples table"""
-        self.c.execute('CREATE TABLE IF NOT EXISTS samples (id INTEGER PRIMARY KEY, alias TEXT, accession TEXT);')
+        self.c.execute('CREATE TABLE IF NOT EXISTS samples (id INTEGER PRIMARY KEY, alias TEXT, accession TEXT, digest TEXT);')
 
     def create_run_table(self):
         """Create the run table"""
-        self.c.execute('CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, alias TEXT, accession TEXT, experiment_id INTEGER);')
+        self.c.execute('CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, alias TEXT, accession TEXT, experiment_id INTEGER, digest TEXT);')
         
     def create_experiment_table(self):
         """Create the run table"""
-        self.c.execute('CREATE TABLE IF NOT EXISTS experiments (id INTEGER PRIMARY KEY, alias TEXT, accession TEXT, project_id INTEGER, sample_id INTEGER);')
+        self.c.execute('CREATE TABLE IF NOT EXISTS experiments (id INTEGER PRIMARY KEY, alias TEXT, accession TEXT, project_id INTEGER, sample_id INTEGER, digest TEXT);')
+
+    def create_checksum_table(self):
+        """Create the file checksum cache table"""
+        self.c.execute('CREATE TABLE IF NOT EXISTS checksums (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, inode INTEGER, md5 TEXT);')
+
+    @Metrics.timed("db.get_checksum")
+    def get_checksum(self, path, size, mtime, inode):
+        """Return the cached md5 of a file, or None if the file has changed"""
+        with self.lock:
+            self.c.execute("select md5 from checksums where path=? and size=? and mtime=? and inode=?;",
+                           (path, size, mtime, inode))
+            row = self.c.fetchone()
+            return row[0] if row else None
+
+    @Metrics.timed("db.add_checksum")
+    def add_checksum(self, path, size, mtime, inode, md5):
+        with self.lock:
+            self.c.execute("insert or replace into checksums (path, size, mtime, inode, md5) VALUES (?,?,?,?,?);",
+                           (path, size, mtime, inode, md5))
+
+    def create_upload_table(self):
+        """Create the table tracking fastq upload progress"""
+        self.c.execute('CREATE TABLE IF NOT EXISTS uploads (name TEXT PRIMARY KEY, path TEXT, size INTEGER, offset INTEGER, status TEXT, md5 TEXT);')
+
+    @Metrics.timed("db.set_upload_progress")
+    def set_upload_progress(self, name, path, size, offset, status, md5=None):
+        """Record how far the upload of a file has come and commit it.
+        md5 is the digest of what was sent, once the upload is verified."""
+        with self.lock:
+            self.c.execute("insert or replace into uploads (name, path, size, offset, status, md5) VALUES (?,?,?,?,?,?);",
+                           (name, path, size, offset, status, md5))
+            self.connection.commit()
+
+    def get_upload_progress(self, name):
+        """Return (path, size, offset, status) of an upload or None"""
+        with self.lock:
+            self.c.execute("select path, size, offset, status from uploads where name=?;", (name,))
+            return self.c.fetchone()
+
+    def get_upload_md5(self, name, path, size):
+        """Return the verified md5 of an upload of path with size, or None"""
+        with self.lock:
+            self.c.execute("select md5 from uploads where name=? and path=? and size=? and status='done';",
+                           (name, path, size))
+            row = self.c.fetchone()
+            return row[0] if row else None
+
+    def create_job_table(self):
+        """Create the table of isolate jobs and their stages"""
+        self.c.execute('CREATE TABLE IF NOT EXISTS jobs (alias TEXT PRIMARY KEY, batch TEXT, project TEXT, files TEXT, stage TEXT, worker TEXT, claimed_at REAL, error TEXT, attempts INTEGER DEFAULT 0);')
+        self.c.execute('CREATE INDEX IF NOT EXISTS jobs_stage ON jobs (stage, batch);')
+
+    @Metrics.timed("db.add_jobs")
+    def add_jobs(self, rows):
+        """Queue (alias, batch, project, files) jobs in one transaction.
+        A job that already exists starts over if its files changed or if
+        it was finished, otherwise it keeps its stage. Either way its
+        error and failed attempts are forgotten."""
+        with self.lock, self.connection:
+            self.c.executemany("insert into jobs (alias, batch, project, files, stage) VALUES (?,?,?,?,'queued') "
+                               "on conflict(alias) do update set batch=excluded.batch, project=excluded.project, files=excluded.files, error=null, attempts=0, "
+                               "stage=case when jobs.files!=excluded.files or jobs.stage='run_submitted' then 'queued' else jobs.stage end;",
+                               rows)
+
+    @Metrics.timed("db.claim_jobs")
+    def claim_jobs(self, worker, batch=None, limit=None, stale_after=3600,
+                   retry_errors=False, max_attempts=None):
+        """Claim unfinished jobs for worker and return them as
+        (alias, project, files, stage) rows. Jobs claimed by another worker
+        are only taken over when its claim is older than stale_after seconds.
+        Jobs with an error are left alone unless retry_errors is set, and
+        then only until they have failed max_attempts times."""
+        now = time.time()
+        query = ("select alias from jobs where stage!='run_submitted' "
+                 "and (worker is null or (worker!=? and claimed_at<?))")
+        params = [worker, now - stale_after]
+        if not retry_errors:
+            query += " and error is null"
+        elif max_attempts:
+            query += " and (error is null or attempts<?)"
+            params.append(max_attempts)
+        if batch is not None:
+            query += " and batch=?"
+            params.append(batch)
+        if limit:
+            query += " limit ?"
+            params.append(limit)
+        with self.lock:
+            self.connection.commit()
+            ## Take the write lock up front so two workers can't claim the same job
+            self.c.execute('BEGIN IMMEDIATE;')
+            try:
+                self.c.execute(query + ";", params)
+                aliases = [row[0] for row in self.c.fetchall()]
+                self.c.executemany("update jobs set worker=?, claimed_at=? where alias=?;",
+                                   ((worker, now, alias) for alias in aliases))
+                self.connection.commit()
+            except:
+                self.connection.rollback()
+                raise
+            return self.get_jobs(aliases)
+
+    def get_unfinished_jobs(self, batch=None):
+        """Return (alias, project, files, stage) of the unfinished jobs of a
+        batch (all batches if None) without claiming them"""
+        query = "select alias, project, files, stage from jobs where stage!='run_submitted'"
+        params = []
+        if batch is not None:
+            query += " and batch=?"
+            params.append(batch)
+        with self.lock:
+            self.c.execute(query + ";", params)
+            return self.c.fetchall()
+
+    def get_failed_jobs(self, batch=None):
+        """Return (alias, attempts, error) of the unfinished jobs of a batch
+        (all batches if None) that have an error"""
+        query = "select alias, attempts, error from jobs where stage!='run_submitted' and error is not null"
+        params = []
+        if batch is not None:
+            query += " and batch=?"
+            params.append(batch)
+        with self.lock:
+            self.c.execute(query + " order by alias;", params)
+            return self.c.fetchall()
+
+    def get_jobs(self, aliases):
+        """Return (alias, project, files, stage) of jobs"""
+        aliases = list(aliases)
+        jobs = list()
+        with self.lock:
+            for i in range(0, len(aliases), 500):
+                batch = aliases[i:i+500]
+                self.c.execute("select alias, project, files, stage from jobs where alias in (" +
+                               ",".join("?"*len(batch)) + ");", batch)
+                jobs.extend(self.c.fetchall())
+        return jobs
+
+    @Metrics.timed("db.set_job_stage")
+    def set_job_stage(self, aliases, stage):
+        """Move jobs forward to stage and commit, clearing their error and
+        failed attempts. Jobs already past it are left alone."""
+        later = job_stages[job_stages.index(stage):]
+        with self.lock, self.connection:
+            self.c.executemany("update jobs set stage=?, claimed_at=?, error=null, attempts=0 where alias=? and stage not in (" +
+                               ",".join("?"*len(later)) + ");",
+                               ((stage, time.time(), alias) + later for alias in aliases))
+
+    def set_job_error(self, aliases, error):
+        """Record why jobs failed and count the failed attempt"""
+        with self.lock, self.connection:
+            self.c.executemany("update jobs set error=?, attempts=attempts+1 where alias=?;",
+                               ((error, alias) for alias in aliases))
+
+    def release_jobs(self, worker):
+        """Give up the claims of worker on unfinished jobs"""
+        with self.lock, self.connection:
+            self.c.execute("update jobs set worker=null, claimed_at=null where worker=?;", (worker,))
+
+    def create_action_table(self):
+        """Create the table tracking bulk MODIFY and CANCEL batches"""
+        self.c.execute('CREATE TABLE IF NOT EXISTS actions (batch TEXT, object_table TEXT, alias TEXT, accession TEXT, action TEXT, status TEXT, error TEXT, updated_at REAL, PRIMARY KEY (batch, object_table, alias));')
+
+    @Metrics.timed("db.add_actions")
+    def add_actions(self, batch, action, table, targets):
+        """Add (alias, accession) targets of an action to a batch in one
+        transaction. Targets already in the batch keep their status."""
+        now = time.time()
+        with self.lock, self.connection:
+            self.c.executemany("insert or ignore into actions (batch, object_table, alias, accession, action, status, updated_at) VALUES (?,?,?,?,?,'pending',?);",
+                               ((batch, table, alias, accession, action, now) for alias, accession in targets))
+
+    def get_actions(self, batch, table):
+        """Return (alias, accession) of the targets of a batch that are not done"""
+        with self.lock:
+            self.c.execute("select alias, accession from actions where batch=? and object_table=? and status!='done' order by rowid;",
+                           (batch, table))
+            return self.c.fetchall()
+
+    def get_action_status(self, batch, table):
+        """Return {alias: status} of all targets of a batch"""
+        with self.lock:
+            self.c.execute("select alias, status from actions where batch=? and object_table=?;",
+                           (batch, table))
+            return dict(self.c.fetchall())
+
+    def count_actions(self, batch, table):
+        """Return {status: number of targets} of a batch"""
+        with self.lock:
+            self.c.execute("select status, count(*) from actions where batch=? and object_table=? group by status;",
+                           (batch, table))
+            return dict(self.c.fetchall())
+
+    @Metrics.timed("db.set_action_status")
+    def set_action_status(self, batch, table, rows):
+        """Set the status of (alias, status, error) targets of a batch and commit"""
+        now = time.time()
+        with self.lock, self.connection:
+            self.c.executemany("update actions set status=?, error=?, updated_at=? where batch=? and object_table=? and alias=?;",
+                               ((status, error, now, batch, table, alias) for alias, status, error in rows))
 
     def create_tables(self):
         self.create_project_table()
         self.create_sample_table()
         self.create_experiment_table()
         self.create_run_table()
+        self.create_checksum_table()
+        self.create_upload_table()
+        self.create_job_table()
+        self.create_action_table()
+
+    def migrate(self):
+        """Bring a DB created by an older version up to schema_version"""
+        with self.lock:
+            self.c.execute('PRAGMA user_version;')
+            version = self.c.fetchone()[0]
+            if version < 1:
+                ## Tables created before digests were tracked
+                for table in ('samples', 'experiments', 'runs'):
+                    self.add_column(table, 'digest', 'TEXT')
+                ## Aliases were not unique, so every run added duplicates.
+                #  Keep one row per alias, preferring one with an accession
+                for table, child, key in (('samples', 'experiments', 'sample_id'),
+                                          ('experiments', 'runs', 'experiment_id'),
+                                          ('runs', None, None)):
+                    self.deduplicate(table, child, key)
+                self.c.execute('CREATE UNIQUE INDEX IF NOT EXISTS samples_alias ON samples (alias);')
+                self.c.execute('CREATE UNIQUE INDEX IF NOT EXISTS experiments_alias ON experiments (alias);')
+                self.c.execute('CREATE UNIQUE INDEX IF NOT EXISTS runs_alias ON runs (alias);')
+                self.c.execute('CREATE INDEX IF NOT EXISTS experiments_sample ON experiments (sample_id);')
+                self.c.execute('CREATE INDEX IF NOT EXISTS runs_experiment ON runs (experiment_id);')
+            if version < 2:
+                ## Uploads were not verified, so there is no digest to keep
+                self.add_column('uploads', 'md5', 'TEXT')
+            if version < 3:
+                ## Failed jobs were retried for ever
+                self.add_column('jobs', 'attempts', 'INTEGER DEFAULT 0')
+            self.c.execute('PRAGMA user_version={};'.format(schema_version))
+            self.connection.commit()
+
+    def deduplicate(self, table, child=None, key=None):
+        """Remove rows with duplicate aliases from table, pointing the key
+        column of the child table at the row that is kept"""
+        self.c.execute('DROP TABLE IF EXISTS temp.keep;')
+        self.c.execute('CREATE TEMP TABLE keep AS SELECT alias, COALESCE(MIN(CASE WHEN accession IS NOT NULL THEN id END), MIN(id)) AS id FROM ' + table + ' GROUP BY alias;')
+        if child is not None:
+            self.c.execute('UPDATE ' + child + ' SET ' + key + '=(SELECT keep.id FROM keep JOIN ' + table + ' t ON t.alias=keep.alias WHERE t.id=' + child + '.' + key + ') WHERE ' + key + ' IS NOT NULL;')
+        self.c.execute('DELETE FROM ' + table + ' WHERE id NOT IN (SELECT id FROM keep);')
+        self.c.execute('DROP TABLE keep;')
 
     def start_transaction(self):
         """Begin a transaction group"""
-        self.c.execute('BEGIN TRANSACTION;')
+        with self.lock:
+            self.c.execute('BEGIN TRANSACTION;')
 
     def commit_transaction(self):
         """End a transaction group"""
-        self.c.execute('COMMIT TRANSACTION;')
+        with self.lock:
+            self.c.execute('COMMIT TRANSACTION;')
 
+    @Metrics.timed("db.commit")
     def commit(self):
         """End a transaction group"""
-        self.connection.commit()
+        with self.lock:
+            self.connection.commit()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import os
+import time
+
+fastq_suffixes = ('.fastq.gz', '.fq.gz', '.fastq', '.fq')
+
+class Watcher:
+    """Watch a drop directory or an appendable fastq list for new fastq
+    pairs and hand them out in micro-batches of up to batch_size pairs,
+    or fewer once the oldest waiting pair has waited window seconds.
+
+    In a directory, files are grouped by the part of their name before
+    the first '_' like fqfile.alias, and a pair is ready once it has
+    files_per_isolate files whose sizes did not change between two polls.
+    In a fastq list, every complete new line is a pair."""
+
+    def __init__(self, path, batch_size=50, window=300, poll=10, files_per_isolate=2):
+        self.path = path
+        self.batch_size = batch_size
+        self.window = window
+        self.poll = poll
+        self.files_per_isolate = files_per_isolate
+        self.offset = 0
+        self.sizes = dict()
+        self.seen = set()
+        ## (arrival time, pair) of the pairs waiting for a batch
+        self.pending = list()
+
+    def scan_directory(self):
+        """Return the pairs in the directory that became ready since the last scan"""
+        groups = dict()
+        sizes = dict()
+        for entry in os.scandir(self.path):
+            if not entry.is_file() or not entry.name.endswith(fastq_suffixes):
+                continue
+            sizes[entry.path] = entry.stat().st_size
+            groups.setdefault(entry.name.split('_')[0], list()).append(entry.path)
+        ready = list()
+        for alias, paths in groups.items():
+            if alias in self.seen or len(paths) != self.files_per_isolate:
+                continue
+            if all(self.sizes.get(path) == sizes[path] for path in paths):
+                self.seen.add(alias)
+                ready.append(sorted(paths))
+        self.sizes = sizes
+        return ready
+
+    def scan_list(self):
+        """Return the pairs on complete lines appended to the list since the last scan"""
+        ready = list()
+        with open(self.path) as fh:
+            fh.seek(self.offset)
+            for line in iter(fh.readline, ''):
+                if not line.endswith('\n'):
+                    break # still being written
+                self.offset = fh.tell()
+                if line.startswith('#') or not line.strip():
+                    continue
+                ready.append(line.strip().split("\t"))
+        return ready
+
+    def scan(self):
+        if os.path.isdir(self.path):
+            return self.scan_directory()
+        return self.scan_list()
+
+    def batches(self):
+        """Yield micro-batches of pairs for ever"""
+        while True:
+            now = time.monotonic()
+            self.pending.extend((now, pair) for pair in self.scan())
+            while len(self.pending) >= self.batch_size:
+                yield [pair for arrived, pair in self.pending[:self.batch_size]]
+                self.pending = self.pending[self.batch_size:]
+            if self.pending and time.monotonic() - self.pending[0][0] >= self.window:
+                yield [pair for arrived, pair in self.pending]
+                self.pending = list()
+            time.sleep(self.poll)
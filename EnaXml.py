@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import io
+import threading
+import functools
+import xml.etree.ElementTree as ET
+
+def tv_element(tag,value):
+    element = ET.Element(tag)
+    element.text = str(value)
+    return element
+
+def sample_element(alias, taxon_id_or_name, sample_attributes):
+    sample = ET.Element("SAMPLE",{'alias':alias})
+    sample_name = ET.SubElement(sample, "SAMPLE_NAME")
+    if type(taxon_id_or_name) is int or taxon_id_or_name.isnumeric(): 
+        sample_name.append(tv_element("TAXON_ID",str(taxon_id_or_name)))
+    else:
+        sample_name.append(tv_element("SCIENTIFIC_NAME",taxon_id_or_name))
+    sampleattributes=ET.SubElement(sample, "SAMPLE_ATTRIBUTES")
+    for tag,value in sample_attributes.items():
+        sample_attribute = ET.SubElement(sampleattributes,"SAMPLE_ATTRIBUTE")
+        sample_attribute.append(tv_element("TAG",tag))
+        sample_attribute.append(tv_element("VALUE",value))
+    return sample
+
+def experiment_element(alias, sample_alias, project, center_name, library, platform):
+    """EXPERIMENT referring to a sample. library and platform are appended
+    as they are, so cached template elements are shared, not copied."""
+    experiment = ET.Element("EXPERIMENT",
+                            {'alias': alias,
+                             'center_name': center_name})
+    ET.SubElement(experiment, "STUDY_REF", {'refname':project})
+    design = ET.SubElement(experiment, "DESIGN")
+    ET.SubElement(design,"DESIGN_DESCRIPTION")
+    ET.SubElement(design,"SAMPLE_DESCRIPTOR", {'refname':sample_alias})
+    design.append(library)
+    experiment.append(platform)
+    return experiment
+
+def run_element(alias, experiment_alias, center_name, files):
+    """RUN of an experiment, files is a list of (name, md5)"""
+    run = ET.Element("RUN",
+                     {'alias': alias,
+                      'center_name': center_name})
+    ET.SubElement(run, "EXPERIMENT_REF", {'refname':experiment_alias})
+    data_block = ET.SubElement(run,"DATA_BLOCK")
+    files_element = ET.SubElement(data_block,"FILES")
+    for name, md5 in files:
+        ET.SubElement(files_element, "FILE", {'filename':"fastqs/"+name,
+                                              'filetype':"fastq",
+                                              'checksum_method':'MD5',
+                                              'checksum':md5})
+    return run
+
+@functools.lru_cache(maxsize=None)
+def submission(action="ADD", releasedate=None):
+    """The SUBMISSION document for an action, with a HOLD if releasedate is set"""
+    submit = ET.Element('SUBMISSION')
+    actions = ET.SubElement(submit, "ACTIONS")
+    addaction = ET.SubElement(actions, "ACTION")
+    ET.SubElement(addaction, action)
+    if releasedate is not None:
+        holdaction = ET.SubElement(actions, "ACTION")
+        ET.SubElement(holdaction, "HOLD", {'HoldUntilDate': releasedate})
+    return ET.tostring(submit,encoding="unicode")
+
+def target_submission(action, targets):
+    """The SUBMISSION document applying an action such as CANCEL to every
+    target accession, one ACTION each"""
+    submit = ET.Element('SUBMISSION')
+    actions = ET.SubElement(submit, "ACTIONS")
+    for target in targets:
+        ET.SubElement(ET.SubElement(actions, "ACTION"), action, {'target': target})
+    return ET.tostring(submit,encoding="unicode")
+
+_buffers = threading.local()
+
+def write_set(settag, objects, buf=None):
+    """Serialize objects one at a time into a <settag> document and return
+    the buffer, rewound. Without buf, a buffer kept per thread is cleared
+    and reused, so it is only valid until the thread's next call."""
+    if buf is None:
+        buf = getattr(_buffers, 'buf', None)
+        if buf is None:
+            buf = _buffers.buf = io.StringIO()
+        buf.seek(0)
+        buf.truncate()
+    buf.write("<{}>".format(settag))
+    for obj in objects:
+        ET.ElementTree(obj).write(buf, encoding="unicode")
+    buf.write("</{}>".format(settag))
+    buf.seek(0)
+    return buf
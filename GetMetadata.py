@@ -3,12 +3,96 @@
 import xml.etree.ElementTree as ET
 import json
 import sys
+import copy
+import functools
+import hashlib
+import os
+import sqlite3
+from collections.abc import Mapping
+
+## Danish to English country names, shipped next to this module
+countries_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dk_to_en_country.json")
+
+@functools.lru_cache(maxsize=None)
+def dk_to_en_country(path=None):
+    """The country name table, read on first use"""
+    with open(path or countries_path,'r') as fh:
+        return json.load(fh)
+
+def travel_relation(country):
+    """Travel attributes for the country of travel field of the export"""
+    if country=="DANMARK":
+        return {'travel-relation':"not travel-related"}
+    elif country=="Uoplyst" or country=='':
+        return {'travel-relation':"not ascertainable"}
+    elif country=="JA, MEN LAND UKENDT":
+        return {'travel-relation':"travel-related"}
+    english = dk_to_en_country().get(country)
+    if english is not None:
+        return {'travel-relation':"travel-related",
+                'Country of travel':english}
+    print("Unknown country of travel \"{}\"".format(country), file=sys.stderr)
+    return {'travel-relation':"travel-related"}
+
+def parse_isolate(line):
+    """Parse one line of the isolate export into (isolate, attributes).
+    Raises ValueError on a malformed line."""
+    fields = line.strip('\n').split('\t')
+    isolate = fields[0]
+    try:
+        attributes = {'isolate':isolate,
+                      'serovar':fields[1],
+                      'sub_type':"ST"+fields[2],
+                      'collection date':"{2}-{1}".format(*fields[3].split("-"))}
+        attributes.update(travel_relation(fields[4]))
+    except IndexError:
+        raise ValueError("Malformed isolate line: {}".format(fields))
+    return isolate, attributes
+
+def parse_isolates(lines, aliases=None):
+    """Yield (isolate, attributes) from the lines of an isolate export
+    (without the header), only for isolates in aliases if given.
+    Malformed lines are reported and skipped."""
+    for line in lines:
+        if aliases is not None and line.split('\t', 1)[0] not in aliases:
+            continue
+        try:
+            yield parse_isolate(line)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+
+
+class SampleAttrs(Mapping):
+    """Read-only sample attributes of one isolate on top of a block of
+    defaults shared by all isolates, which is not copied"""
+    __slots__ = ('defaults', 'attributes')
+
+    def __init__(self, defaults, attributes):
+        self.defaults = defaults
+        self.attributes = attributes
+
+    def __getitem__(self, key):
+        try:
+            return self.attributes[key]
+        except KeyError:
+            return self.defaults[key]
+
+    def __iter__(self):
+        ## Same order as the defaults updated with the attributes
+        yield from self.defaults
+        for key in self.attributes:
+            if key not in self.defaults:
+                yield key
+
+    def __len__(self):
+        return len(self.defaults) + sum(1 for key in self.attributes if key not in self.defaults)
 
-with open("dk_to_en_country.json",'r') as fh:
-    dk_to_en_country = json.load(fh)
 
 class metadata:
-    def __init__(self, isolatefile, checklist):
+    def __init__(self, isolatefile, checklist, aliases=None, index=None):
+        """Metadata of the isolates in isolatefile. If aliases is given only
+        those isolates are kept. With an IsolateIndex they are looked up in
+        the index, after bringing it up to date with isolatefile."""
         self.metadata =  {'ENA_CHECKLIST':checklist,
                 'collected_by':'Statens Serum Institute',
                 'geographic location':'Denmark',
@@ -18,38 +102,88 @@ class metadata:
                 'host health state':'not collected',
                 'host scientific name':'Homo Sapiens',
                 'Is the sequenced pathogen host associated?':'Yes'}
-        self.parse_isolatefile(isolatefile)
+        if index is not None:
+            index.refresh(isolatefile.name)
+            self.isolate_metadata = index.lookup(aliases)
+        else:
+            self.parse_isolatefile(isolatefile, aliases)
     
-    def parse_isolatefile(self,isolatefile):
+    def parse_isolatefile(self,isolatefile, aliases=None):
         header = next(isolatefile).split('\t') # headers from BN fields
-        isolate_metadata = dict()
-        for line in isolatefile:
-            fields = line.strip('\n').split('\t')
-            isolate = fields[0]
-            try:
-                isolate_metadata[isolate]={'isolate':isolate,
-                                           'serovar':fields[1],
-                                           'sub_type':"ST"+fields[2],
-                                           'collection date':"{2}-{1}".format(*fields[3].split("-"))}
-            except IndexError:
-                print(fields)
-                sys.exit
-            if fields[4]=="DANMARK":
-                isolate_metadata[isolate].update({'travel-relation':"not travel-related"})
-            elif fields[4]=="Uoplyst" or fields[4]=='':
-                isolate_metadata[isolate].update({'travel-relation':"not ascertainable"})
-            elif fields[4]=="JA, MEN LAND UKENDT":
-                isolate_metadata[isolate].update({'travel-relation':"travel-related"})
-            else:
-                isolate_metadata[isolate].update({'travel-relation':"travel-related",
-                                                  'Country of travel':dk_to_en_country[fields[4]]})
-        self.isolate_metadata = isolate_metadata
+        self.isolate_metadata = dict(parse_isolates(isolatefile, aliases))
         return self.isolate_metadata
 
+    def __contains__(self, isolateid):
+        return isolateid in self.isolate_metadata
+
     def get(self, isolateid):
+        return SampleAttrs(self.metadata, self.isolate_metadata[isolateid])
+
+
+class IsolateIndex:
+    """Parsed isolate export kept in an SQLite file, so a submission only
+    has to look up its own isolates. The index is refreshed when the
+    export's mtime or size changes; if the export has only been appended
+    to, just the new lines are parsed."""
+    def __init__(self, dbname):
+        self.connection = sqlite3.connect(dbname)
+        self.c = self.connection.cursor()
+        self.c.execute('CREATE TABLE IF NOT EXISTS isolates (alias TEXT PRIMARY KEY, attributes TEXT);')
+        self.c.execute('CREATE TABLE IF NOT EXISTS source (path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, offset INTEGER, md5 TEXT);')
+        self.connection.commit()
+
+    def refresh(self, path, blocksize=1024*1024):
+        """Bring the index up to date with the export at path"""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        self.c.execute("select mtime, size, offset, md5 from source where path=?;", (path,))
+        row = self.c.fetchone()
+        if row is not None and row[:2] == (st.st_mtime_ns, st.st_size):
+            return
+        with open(path, 'rb') as fh:
+            m = hashlib.md5()
+            offset = 0
+            if row is not None and st.st_size >= row[2]:
+                ## Only appended to if the indexed part is unchanged
+                while fh.tell() < row[2]:
+                    m.update(fh.read(min(blocksize, row[2] - fh.tell())))
+                if m.hexdigest() == row[3]:
+                    offset = row[2]
+            if offset == 0:
+                self.c.execute("delete from isolates;")
+                fh.seek(0)
+                m = hashlib.md5()
+                header = fh.readline()
+                m.update(header)
+                offset = len(header)
+            end = [offset]
+            def complete_lines():
+                for line in iter(fh.readline, b''):
+                    if not line.endswith(b'\n'):
+                        break # still being written
+                    m.update(line)
+                    end[0] += len(line)
+                    yield line.decode()
+            self.c.executemany("insert or replace into isolates (alias, attributes) VALUES (?,?);",
+                               ((isolate, json.dumps(attributes))
+                                for isolate, attributes in parse_isolates(complete_lines())))
+            offset = end[0]
+        self.c.execute("insert or replace into source (path, mtime, size, offset, md5) VALUES (?,?,?,?,?);",
+                       (path, st.st_mtime_ns, st.st_size, offset, m.hexdigest()))
+        self.connection.commit()
+
+    def lookup(self, aliases):
+        """Return {alias: attributes} for the aliases found in the index"""
+        if aliases is None:
+            self.c.execute("select alias, attributes from isolates;")
+            return {alias: json.loads(a) for alias, a in self.c.fetchall()}
+        aliases = list(aliases)
         result = dict()
-        result.update(self.metadata)
-        result.update(self.isolate_metadata[isolateid])
+        for i in range(0, len(aliases), 500):
+            batch = aliases[i:i+500]
+            self.c.execute("select alias, attributes from isolates where alias in (" +
+                           ",".join("?"*len(batch)) + ");", batch)
+            result.update((alias, json.loads(a)) for alias, a in self.c.fetchall())
         return result
 
 def getmetadata(isolateid, checklist, isolate_attributes):
@@ -65,9 +199,7 @@ def getmetadata(isolateid, checklist, isolate_attributes):
                 'Is the sequenced pathogen host associated?':'Yes'}
     
 
-def getlibrary(isolateid):
-    params = {'insertsize':500,'insertsd':200}
-    library_description = """<LIBRARY_DESCRIPTOR>
+library_description = """<LIBRARY_DESCRIPTOR>
      <LIBRARY_NAME/>
      <LIBRARY_STRATEGY>WGS</LIBRARY_STRATEGY>
      <LIBRARY_SOURCE>GENOMIC</LIBRARY_SOURCE>
@@ -78,13 +210,27 @@ def getlibrary(isolateid):
      <LIBRARY_CONSTRUCTION_PROTOCOL>Library was prepared using Illumina Nextera XT Kit.
      </LIBRARY_CONSTRUCTION_PROTOCOL>
  </LIBRARY_DESCRIPTOR>"""
-    return ET.fromstring(library_description.format(**params))
 
-def getplatform(isolateid):
-    params = {'platform':"Illumina Nextseq 500"}
-    platform = """<PLATFORM>
+platform_description = """<PLATFORM>
     <ILLUMINA>
          <INSTRUMENT_MODEL>{platform}</INSTRUMENT_MODEL>
     </ILLUMINA>
     </PLATFORM>"""
-    return ET.fromstring(platform.format(**params))
+
+@functools.lru_cache(maxsize=None)
+def library_template(insertsize=500, insertsd=200):
+    """LIBRARY_DESCRIPTOR parsed once per set of parameters. The element
+    is shared by every caller and must not be modified."""
+    return ET.fromstring(library_description.format(insertsize=insertsize, insertsd=insertsd))
+
+@functools.lru_cache(maxsize=None)
+def platform_template(platform="Illumina Nextseq 500"):
+    """PLATFORM parsed once per platform. The element is shared by every
+    caller and must not be modified."""
+    return ET.fromstring(platform_description.format(platform=platform))
+
+def getlibrary(isolateid):
+    return copy.deepcopy(library_template())
+
+def getplatform(isolateid):
+    return copy.deepcopy(platform_template())
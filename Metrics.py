@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import threading
+import functools
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class Metrics:
+    """Stage timings, counters and per-isolate outcomes of a run.
+
+    Every timed stage is written as a line of JSON to log (a path or an
+    open file) and summed up per stage for the Prometheus text format,
+    which is written to prometheus_file by write_prometheus and served by
+    serve. Counters only show up in the Prometheus output. Without a log
+    and a Prometheus file nothing is recorded and timer returns a context
+    that does nothing."""
+
+    def __init__(self, log=None, prometheus_file=None, prefix="enaupload"):
+        self.enabled = log is not None or prometheus_file is not None
+        self.own_log = isinstance(log, str)
+        if self.own_log:
+            log = open(log, 'a', buffering=1)
+        self.log_file = log
+        self.prometheus_file = prometheus_file
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        ## {stage: [count, seconds]}
+        self.durations = dict()
+        ## {(name, ((label, value), ...)): value}
+        self.counters = dict()
+        self.server = None
+
+    def log(self, event, **fields):
+        """Write an event to the JSON lines log"""
+        if self.log_file is None:
+            return
+        line = json.dumps(dict(time=time.time(), event=event, **fields), default=str)
+        with self.lock:
+            self.log_file.write(line + "\n")
+
+    def timer(self, stage, **fields):
+        """Context timing a stage. It yields fields, so numbers only known
+        at the end (bytes, objects) can be added to the logged event."""
+        if not self.enabled:
+            return contextlib.nullcontext(fields)
+        return self._timer(stage, fields)
+
+    @contextlib.contextmanager
+    def _timer(self, stage, fields):
+        start = time.perf_counter()
+        try:
+            yield fields
+        except BaseException as e:
+            fields['error'] = repr(e)
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start, **fields)
+
+    def observe(self, stage, seconds, log=True, **fields):
+        """Record that a stage took seconds, fields go to the log unless
+        log is False"""
+        if not self.enabled:
+            return
+        with self.lock:
+            duration = self.durations.setdefault(stage, [0, 0.0])
+            duration[0] += 1
+            duration[1] += seconds
+        if 'error' in fields:
+            self.count('errors', stage=stage)
+        elif 'bytes' in fields:
+            self.count('bytes', fields['bytes'], stage=stage)
+        if log:
+            self.log(stage, seconds=seconds, **fields)
+
+    def count(self, name, value=1, **labels):
+        """Add value to the counter name with labels"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def outcome(self, alias, objtag, outcome, errors=None):
+        """Record what happened to the object of an isolate"""
+        if not self.enabled:
+            return
+        self.count('objects', object=objtag, outcome=outcome)
+        self.log('outcome', alias=alias, object=objtag, outcome=outcome,
+                 **({'errors': errors} if errors else {}))
+
+    def prometheus(self):
+        """The metrics in the Prometheus text format"""
+        def labels(items):
+            if not items:
+                return ""
+            return "{" + ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for k, v in items) + "}"
+        lines = list()
+        with self.lock:
+            name = self.prefix + "_stage_seconds"
+            lines.append("# TYPE {} summary".format(name))
+            for stage, (count, seconds) in sorted(self.durations.items()):
+                lines.append("{}_sum{} {}".format(name, labels([('stage', stage)]), seconds))
+                lines.append("{}_count{} {}".format(name, labels([('stage', stage)]), count))
+            for counter in sorted({counter for counter, l in self.counters}):
+                name = "{}_{}_total".format(self.prefix, counter)
+                lines.append("# TYPE {} counter".format(name))
+                for (c, items), value in sorted(self.counters.items()):
+                    if c == counter:
+                        lines.append("{}{} {}".format(name, labels(items), value))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self):
+        """Write the Prometheus text file, replacing it in one go so a
+        collector never sees half of it"""
+        if self.prometheus_file is None:
+            return
+        tmp = self.prometheus_file + ".tmp"
+        with open(tmp, 'w') as fh:
+            fh.write(self.prometheus())
+        os.replace(tmp, self.prometheus_file)
+
+    def serve(self, port, host=""):
+        """Serve the Prometheus text format on http://host:port/metrics"""
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+        self.enabled = True
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.write_prometheus()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.own_log:
+            self.log_file.close()
+
+
+## Used wherever no Metrics is given
+disabled = Metrics()
+
+def timed(stage):
+    """Decorator timing a method as stage with the metrics of its object.
+    Calls are only summed up, not logged one by one."""
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not self.metrics.enabled:
+                return method(self, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.metrics.observe(stage, time.perf_counter() - start, log=False)
+        return wrapper
+    return decorate
@@ -0,0 +1,31 @@
+import os
+
+import Checklist
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def validator():
+    ## Never older than the ttl, so nothing is downloaded
+    return Checklist.load_checklist("ERC000029", cache_dir=here, ttl=float('inf'))
+
+def test_fields():
+    checklist = validator()
+    assert checklist.mandatory == ["serovar", "collection date"]
+    assert list(checklist.regexes) == ["collection date"]
+    assert checklist.choices == {'travel-relation': {"travel-related", "not travel-related"}}
+
+def test_check():
+    checklist = validator()
+    assert checklist.check({'serovar': "Typhimurium", 'collection date': "2020-02",
+                            'travel-relation': "Not Travel-Related", 'host': "anything"}) == []
+    assert checklist.check({'serovar': "", 'collection date': "02-2020",
+                            'travel-relation': "abroad"}) == [
+        "serovar: mandatory field missing",
+        'collection date: "02-2020" does not match regex "[12][0-9]{3}(-[01][0-9])?|not collected"',
+        'travel-relation: "abroad" is not an allowed value']
+
+def test_validate():
+    checklist = validator()
+    report = checklist.validate({'S1': {'serovar': "Typhimurium", 'collection date': "2020"},
+                                 'S2': {'serovar': "Typhimurium"}})
+    assert report == {'S2': ["collection date: mandatory field missing"]}
@@ -0,0 +1,323 @@
+import argparse
+import hashlib
+import os
+
+import pytest
+import requests
+
+import ENAupload
+import EnaClient
+import EnaMock
+import EnaSqlite
+import EnaXml
+
+@pytest.fixture
+def ftp_server(tmp_path):
+    server = EnaMock.MockFtp(tmp_path / "ftp", seed=1).start()
+    yield server
+    server.stop()
+
+@pytest.fixture
+def ftp(ftp_server):
+    session = ENAupload.enaftp("127.0.0.1", ftp_server.server_address[1], user="u", password="p")
+    session.connect()
+    yield session
+    session.close()
+
+@pytest.fixture
+def fastq(tmp_path):
+    path = tmp_path / "S1_R1.fastq"
+    path.write_bytes(os.urandom(3*1024*1024 + 17))
+    return path
+
+@pytest.fixture
+def webin():
+    server = EnaMock.MockWebin(seed=1).start()
+    yield server
+    server.stop()
+
+@pytest.fixture
+def context(webin, tmp_path):
+    db = EnaSqlite.Sqlitedb(str(tmp_path / "ena.sqlite"))
+    context = ENAupload.Context(user_variables={'user': 'u', 'password': 'p', 'centre_name': 'C'},
+                                db=db, url=webin.url, http_retries=0)
+    yield context
+    context.close()
+
+def sample_set(context, aliases, **kwargs):
+    samples = ENAupload.SampleSet(context, None, **kwargs)
+    for alias in aliases:
+        samples.add_sample(alias, alias, 28901, {'serovar': "Typhimurium"})
+    return samples
+
+def remote(server, f):
+    return open(os.path.join(server.root, "fastqs", f.name), 'rb').read()
+
+def fastqs(tmp_path, count, size=2*1024*1024):
+    files = list()
+    for i in range(count):
+        path = tmp_path / "S{}_R1.fastq".format(i)
+        path.write_bytes(os.urandom(size))
+        files.append(ENAupload.fqfile(str(path), hash=False))
+    return files
+
+def test_upload_files_retries(ftp_server, tmp_path):
+    ftp_server.fail_rate = 0.5
+    files = fastqs(tmp_path, 4)
+    stats = ENAupload.upload_files(files, connections=2, retries=20, url="127.0.0.1",
+                                   port=ftp_server.server_address[1], user="u", password="p")
+    assert sorted(name for name, size, seconds in stats) == sorted(f.name for f in files)
+    for f in files:
+        assert remote(ftp_server, f) == open(f.path, 'rb').read()
+
+def test_upload_resumes(ftp_server, ftp, fastq, tmp_path):
+    db = EnaSqlite.Sqlitedb(str(tmp_path / "ena.sqlite"))
+    size = fastq.stat().st_size
+    f = ENAupload.fqfile(str(fastq), hash=False)
+    ftp_server.fail_rate = 1.0
+    with pytest.raises(ENAupload.ftp_errors):
+        ftp.upload(f, db, blocksize=1024*1024)
+    ## As upload_files does after a failed transfer
+    ftp.close()
+    ftp.connect()
+    partial = ftp.remote_size(f.name)
+    assert 0 < partial < size
+    assert db.get_upload_progress(f.name)[:2] == (str(fastq), size)
+    ftp_server.fail_rate = 0.0
+    assert ftp.upload(f, db) == size - partial
+    assert remote(ftp_server, f) == fastq.read_bytes()
+    ## The md5 covers the part sent before the failure too
+    assert f.md5 == hashlib.md5(fastq.read_bytes()).hexdigest()
+
+def test_upload_restarts_files_sent_from_elsewhere(ftp_server, ftp, fastq, tmp_path):
+    db = EnaSqlite.Sqlitedb(str(tmp_path / "ena.sqlite"))
+    size = fastq.stat().st_size
+    ## Left on the server by someone else, or before this DB
+    os.makedirs(os.path.join(ftp_server.root, "fastqs"))
+    with open(os.path.join(ftp_server.root, "fastqs", fastq.name), 'wb') as fh:
+        fh.write(os.urandom(size // 2))
+    f = ENAupload.fqfile(str(fastq), hash=False)
+    assert ftp.upload(f, db) == size
+    assert remote(ftp_server, f) == fastq.read_bytes()
+    ## And the same size but sent from another file
+    other = tmp_path / "other" / fastq.name
+    other.parent.mkdir()
+    other.write_bytes(os.urandom(size))
+    f = ENAupload.fqfile(str(other), hash=False)
+    assert ftp.upload(f, db) == size
+    assert remote(ftp_server, f) == other.read_bytes()
+    assert db.get_upload_progress(f.name)[:2] == (str(other), size)
+
+def test_submit_takes_existing_accessions(context, webin):
+    ## Added by a post whose reply was lost
+    webin.added[('SAMPLE', "S1")] = "ERS999999"
+    samples = sample_set(context, ["S1", "S2"])
+    assert samples.submit()
+    assert context.db.get_accession("S1", 'samples') == "ERS999999"
+    assert context.db.get_accession("S2", 'samples').startswith("ERS")
+    assert samples.errors == {}
+
+class StubSubmitter(ENAupload.ChunkSubmitter):
+    """Rejects chunks with a bad alias in them. The first failures posts
+    get no receipt at all."""
+    objtag = "SAMPLE"
+
+    def __init__(self, bad=(), failures=0, **kwargs):
+        super().__init__(ENAupload.Context(user_variables={}), max_inflight=1, **kwargs)
+        self.bad = set(bad)
+        self.failures = failures
+        self.posted = list()
+
+    def alias(self, obj):
+        return obj
+
+    def post_chunk(self, chunk, action):
+        self.posted.append(list(chunk))
+        if len(self.posted) <= self.failures:
+            raise requests.ConnectionError("Mock failure")
+        receipt = EnaClient.Receipt()
+        receipt.success = not self.bad.intersection(chunk)
+        return receipt
+
+    def store_receipt(self, receipt, chunk):
+        return receipt.success
+
+def test_submit_chunks_bisects():
+    objects = ["S{}".format(i) for i in range(8)]
+    submitter = StubSubmitter(bad=["S5"], chunk_size=4)
+    submitter.objects = objects
+    assert not submitter.submit()
+    assert submitter.failed == ["S5"]
+    ## The bad object is narrowed down by halving its chunk
+    assert sorted(submitter.posted) == sorted([objects[:4], objects[4:], ["S4", "S5"], ["S6", "S7"],
+                                               ["S4"], ["S5"]])
+
+def test_submit_chunks_retries():
+    submitter = StubSubmitter(failures=2, chunk_retries=2)
+    submitter.objects = ["S1", "S2"]
+    assert submitter.submit()
+    assert submitter.posted == [["S1", "S2"]] * 3
+    submitter = StubSubmitter(failures=3, chunk_retries=2)
+    submitter.objects = ["S1", "S2"]
+    assert not submitter.submit()
+    assert submitter.failed == ["S1", "S2"]
+    assert len(submitter.posted) == 3
+
+def test_plan(context):
+    assert sample_set(context, ["S1", "S2"]).submit()
+    accession = context.db.get_accession("S2", 'samples')
+    samples = sample_set(context, ["S1", "S2", "S3"])
+    samples.objects[1].attributes = {'serovar': "Dublin"}
+    samples.plan()
+    assert [isolate.alias for isolate in samples.objects] == ["S3"]
+    assert [isolate.alias for isolate in samples.modified] == ["S2"]
+    assert [isolate.alias for isolate in samples.skipped] == ["S1"]
+    assert samples.submit()
+    ## Modified under the accession it has
+    assert context.db.get_accession("S2", 'samples') == accession
+    samples = sample_set(context, ["S1", "S2", "S3"])
+    samples.objects[1].attributes = {'serovar': "Dublin"}
+    samples.plan()
+    assert len(samples.skipped) == 3
+
+def test_hash_pairs_leaves_out_unreadable(tmp_path):
+    pairs = list()
+    for alias in ("S1", "S2"):
+        pair = [str(tmp_path / "{}_{}.fastq".format(alias, read)) for read in ("R1", "R2")]
+        pairs.append(pair)
+    for path in pairs[0] + pairs[1][:1]:
+        open(path, 'w').write("@r\nACGT\n+\nIIII\n")
+    with pytest.raises(FileNotFoundError):
+        ENAupload.hash_pairs(pairs, workers=1)
+    errors = dict()
+    files = ENAupload.hash_pairs(pairs, workers=1, errors=errors)
+    assert [[f.path for f in pair] for pair in files] == pairs[:1]
+    assert list(errors) == ["S2"]
+
+class FailingFtp(ENAupload.enaftp):
+    def upload(self, f, db=None, **kwargs):
+        if f.alias == "S1":
+            raise ENAupload.error_temp("426 Mock failure")
+        return super().upload(f, db, **kwargs)
+
+def test_upload_files_errors(ftp_server, tmp_path):
+    files = fastqs(tmp_path, 3, size=1024)
+    errors = dict()
+    stats = ENAupload.upload_files(
+        files, connections=2, retries=1, errors=errors,
+        ftp_factory=lambda: FailingFtp("127.0.0.1", ftp_server.server_address[1], user="u", password="p"))
+    ## Only the file that failed is left out
+    assert errors == {files[1]: "426 Mock failure"}
+    assert sorted(name for name, size, seconds in stats) == [files[0].name, files[2].name]
+
+def bulk_args(**kwargs):
+    args = dict(action_batch=None, where=None, dry_run=False, chunk_objects=10, max_inflight=2)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+def action_batches(db):
+    db.c.execute("select distinct batch from actions order by rowid;")
+    return [row[0] for row in db.c.fetchall()]
+
+@pytest.fixture
+def submitted(context):
+    context.db.add_project("P")
+    assert sample_set(context, ["S1", "S2"]).submit()
+    experiments = ENAupload.ExperimentSet(context, "P", "C")
+    for alias in ("S1", "S2"):
+        experiments.add_experiment(alias)
+    assert experiments.submit()
+    return context
+
+def test_bulk_modify(submitted):
+    db = submitted.db
+    accessions = db.select_submitted('experiments')
+    assert ENAupload.bulk_action(submitted, bulk_args(dry_run=True), "MODIFY", 'experiments')
+    assert action_batches(db) == []
+    assert ENAupload.bulk_action(submitted, bulk_args(), "MODIFY", 'experiments')
+    batch, = action_batches(db)
+    assert batch.startswith("MODIFY experiments all ")
+    assert db.get_action_status(batch, 'experiments') == {"exp_S1": 'done', "exp_S2": 'done'}
+    assert db.select_submitted('experiments') == accessions
+
+def test_bulk_cancel(submitted, webin):
+    db = submitted.db
+    webin.reject_rate = 1.0
+    assert not ENAupload.bulk_action(submitted, bulk_args(where="alias='S1'"), "CANCEL", 'samples')
+    batch, = action_batches(db)
+    assert db.get_action_status(batch, 'samples') == {"S1": 'failed'}
+    assert db.get_accession("S1", 'samples') is not None
+    ## Running the batch again sends what is not done
+    webin.reject_rate = 0.0
+    assert ENAupload.bulk_action(submitted, bulk_args(action_batch=batch), "CANCEL", 'samples')
+    assert db.get_action_status(batch, 'samples') == {"S1": 'done'}
+    assert [alias for alias, accession in db.select_submitted('samples')] == ["S2"]
+
+def test_upload(ftp_server, ftp, fastq, tmp_path):
+    db = EnaSqlite.Sqlitedb(str(tmp_path / "ena.sqlite"))
+    f = ENAupload.fqfile(str(fastq), hash=False)
+    assert ftp.upload(f, db) == fastq.stat().st_size
+    assert remote(ftp_server, f) == fastq.read_bytes()
+    assert f.md5 == hashlib.md5(fastq.read_bytes()).hexdigest()
+    assert db.get_upload_md5(f.name, str(fastq), fastq.stat().st_size) == f.md5
+    ## Already on the server
+    f = ENAupload.fqfile(str(fastq), hash=False)
+    assert ftp.upload(f, db) == 0
+    assert f.md5 == hashlib.md5(fastq.read_bytes()).hexdigest()
+
+def test_upload_checks_size(ftp, fastq):
+    f = ENAupload.fqfile(str(fastq), hash=False)
+    sizes = iter([None, fastq.stat().st_size - 1])
+    ftp.remote_size = lambda name: next(sizes)
+    with pytest.raises(ENAupload.error_temp):
+        ftp.upload(f)
+    assert f.md5 is None
+
+def job_args(**kwargs):
+    args = dict(worker="w", claim_size=0, claim_timeout=60, resume=False, max_attempts=3,
+                isolateinfo=None, isolate_index=None, watch=None, validate=False,
+                release_date=None, chunk_objects=10, max_inflight=2, pipeline=False,
+                no_fastq=False, use_async=False, ignore_db=False, dry_run=False,
+                hash_workers=1, hash_chunk_size=1024*1024, mmap=False, rehash=False,
+                ftp_connections=2)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+@pytest.mark.parametrize('no_fastq', [False, True])
+def test_run_jobs_md5(context, ftp_server, tmp_path, monkeypatch, no_fastq):
+    context.ftp_url = "127.0.0.1"
+    context.ftp_port = ftp_server.server_address[1]
+    context.db.add_project("P")
+    export = tmp_path / "export.tsv"
+    export.write_text("isolate\tserovar\tST\tdate\ttravel\n" +
+                      "".join("S{}\tTyphimurium\t19\t01-02-2020\tDANMARK\n".format(i) for i in range(2)))
+    pairs = list()
+    for i in range(2):
+        pair = [tmp_path / "S{}_{}.fastq".format(i, read) for read in ("R1", "R2")]
+        for path in pair:
+            path.write_bytes(os.urandom(1024))
+        pairs.append([str(path) for path in pair])
+    ENAupload.queue_pairs(context.db, pairs, "b", "P")
+    runs = dict()
+    element = EnaXml.run_element
+    def run_element(alias, experiment_alias, center_name, files):
+        runs[alias] = files
+        return element(alias, experiment_alias, center_name, files)
+    monkeypatch.setattr(ENAupload.EnaXml, 'run_element', run_element)
+    stages = list()
+    set_job_stage = context.db.set_job_stage
+    def record_stage(aliases, stage):
+        aliases = list(aliases)
+        if aliases:
+            stages.append(stage)
+        set_job_stage(aliases, stage)
+    monkeypatch.setattr(context.db, 'set_job_stage', record_stage)
+    assert ENAupload.run_jobs(context, job_args(isolateinfo=str(export), no_fastq=no_fastq), "b")
+    ## Fastqs that are uploaded are only hashed as they are sent
+    assert stages[0] == ('hashed' if no_fastq else 'uploaded')
+    for pair in pairs:
+        alias = os.path.basename(pair[0]).split('_')[0]
+        assert runs["run_" + alias] == [(os.path.basename(path), ENAupload.md5sum(path))
+                                        for path in pair]
+    context.db.c.execute("select stage, error from jobs;")
+    assert context.db.c.fetchall() == [('run_submitted', None)] * 2
@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+import ENAupload
+import EnaAsync
+import EnaMock
+import EnaSqlite
+
+@pytest.fixture
+def webin():
+    server = EnaMock.MockWebin(seed=1).start()
+    yield server
+    server.stop()
+
+@pytest.fixture
+def context(webin, tmp_path):
+    db = EnaSqlite.Sqlitedb(str(tmp_path / "ena.sqlite"))
+    db.add_project("P")
+    context = ENAupload.Context(user_variables={'user': 'u', 'password': 'p', 'centre_name': 'C'},
+                                db=db, url=webin.url, http_retries=0)
+    yield context
+    context.close()
+
+def object_sets(context, aliases, tmp_path):
+    samples = ENAupload.SampleSet(context, None)
+    experiments = ENAupload.ExperimentSet(context, "P", "C")
+    runs = ENAupload.RunSet(context, "C")
+    for alias in aliases:
+        pair = list()
+        for read in ("R1", "R2"):
+            path = tmp_path / "{}_{}.fastq".format(alias, read)
+            path.write_text("@{}\nACGT\n+\nIIII\n".format(alias))
+            pair.append(ENAupload.fqfile(str(path)))
+        isolate = ENAupload.Isolate(alias, alias, 28901, {'serovar': "Typhimurium"}, pair)
+        for objset in (samples, experiments, runs):
+            objset.add_isolate(isolate)
+    return samples, experiments, runs
+
+def test_run(context, tmp_path):
+    aliases = ["S{}".format(i) for i in range(6)]
+    engine = EnaAsync.DagEngine(context.db, concurrency=3)
+    assert asyncio.run(engine.run(*object_sets(context, aliases, tmp_path)))
+    assert not engine.failed
+    assert sorted(engine.latencies) == aliases
+    for alias in aliases:
+        assert context.db.get_accession(alias, 'samples').startswith("ERS")
+        assert context.db.get_accession("exp_" + alias, 'experiments').startswith("ERX")
+        assert context.db.get_accession("run_" + alias, 'runs').startswith("ERR")
+    assert engine.summary().startswith("Submitted 6 isolates, 0 failed")
+
+def test_run_rejected(context, webin, tmp_path):
+    webin.reject_rate = 1.0
+    engine = EnaAsync.DagEngine(context.db)
+    assert not asyncio.run(engine.run(*object_sets(context, ["S1", "S2"], tmp_path)))
+    assert engine.failed == {"S1": "SAMPLE", "S2": "SAMPLE"}
+    assert "Mock rejection" in engine.errors["S1"][0]
+    ## The children of a rejected sample are not posted
+    assert context.db.get_accession("exp_S1", 'experiments') is None
+
+def test_run_child_of_submitted_parent(context, tmp_path):
+    samples, experiments, runs = object_sets(context, ["S1"], tmp_path)
+    engine = EnaAsync.DagEngine(context.db)
+    assert asyncio.run(engine.run(samples))
+    ## The sample has its accession, so the experiment starts its own chain
+    assert asyncio.run(engine.run(experiments, runs))
+    assert context.db.get_accession("run_S1", 'runs') is not None
@@ -0,0 +1,115 @@
+import io
+import socket
+
+import pytest
+import requests
+
+import EnaClient
+import EnaMock
+import EnaXml
+
+def sample_set(alias):
+    return EnaXml.write_set("SAMPLE_SET", [EnaXml.sample_element(alias, 28901, {'serovar': "Typhimurium"})])
+
+def submission():
+    return io.StringIO(EnaXml.submission("ADD"))
+
+@pytest.fixture
+def webin():
+    server = EnaMock.MockWebin(seed=1).start()
+    yield server
+    server.stop()
+
+def test_retries_until_accepted(webin):
+    webin.error_rate = 0.5
+    client = EnaClient.SubmissionClient(webin.url, ('u', 'p'), retries=20, backoff=0)
+    for i in range(5):
+        receipt = client.submit({'SAMPLE': sample_set("S{}".format(i)), 'SUBMISSION': submission()})
+        assert receipt.success
+        assert receipt.accession("S{}".format(i)).startswith("ERS")
+    stats = client.stats()
+    assert stats['retries'] > 0
+    ## Every attempt got a response, the 503s included
+    assert stats['requests'] == 5 + stats['retries']
+    assert stats['max_latency'] >= stats['mean_latency'] > 0
+    client.close()
+
+def test_gives_up_after_retries(webin):
+    webin.error_rate = 1.0
+    client = EnaClient.SubmissionClient(webin.url, ('u', 'p'), retries=2, backoff=0)
+    with pytest.raises(requests.HTTPError):
+        client.submit({'SAMPLE': sample_set("S1"), 'SUBMISSION': submission()})
+    assert client.stats()['requests'] == 3
+    assert client.stats()['retries'] == 2
+    client.close()
+
+def test_retries_when_refused():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    client = EnaClient.SubmissionClient("http://127.0.0.1:{}/".format(port), ('u', 'p'),
+                                        retries=2, backoff=0)
+    with pytest.raises(requests.ConnectionError):
+        client.submit({'SAMPLE': sample_set("S1"), 'SUBMISSION': submission()})
+    assert client.stats()['retries'] == 2
+    client.close()
+
+def test_no_retry_without_reply(webin):
+    webin.drop_rate = 1.0
+    client = EnaClient.SubmissionClient(webin.url, ('u', 'p'), retries=2, backoff=0)
+    with pytest.raises(requests.ConnectionError):
+        client.submit({'SAMPLE': sample_set("S1"), 'SUBMISSION': submission()})
+    ## Webin may have processed it, so it isn't sent again
+    assert client.stats()['retries'] == 0
+    assert list(webin.added) == [('SAMPLE', "S1")]
+    client.close()
+
+def test_existing(webin):
+    client = EnaClient.SubmissionClient(webin.url, ('u', 'p'), retries=0)
+    accession = client.submit({'SAMPLE': sample_set("S1"), 'SUBMISSION': submission()}).accession("S1")
+    receipt = client.submit({'SAMPLE': sample_set("S1"), 'SUBMISSION': submission()})
+    assert not receipt.success
+    assert receipt.existing == {"S1": accession}
+    client.close()
+
+def test_keep_text(webin):
+    client = EnaClient.SubmissionClient(webin.url, ('u', 'p'), retries=0)
+    receipt = client.submit({'SAMPLE': sample_set("S1"), 'SUBMISSION': submission()}, keep_text=True)
+    assert receipt.success
+    assert 'alias="S1"' in receipt.text
+    client.close()
+
+def test_parse_receipt_success():
+    receipt = EnaClient.parse_receipt(io.BytesIO(b"""<?xml version="1.0" encoding="UTF-8"?>
+<RECEIPT receiptDate="2020-01-01T00:00:00" submissionFile="SUBMISSION" success="true">
+  <SAMPLE accession="ERS000001" alias="S1" status="PRIVATE"><EXT_ID accession="SAMEA1" type="biosample"/></SAMPLE>
+  <EXPERIMENT accession="ERX000002" alias="exp_S1" status="PRIVATE"/>
+  <RUN accession="ERR000003" alias="run_S1" status="PRIVATE"/>
+  <SUBMISSION accession="ERA000004" alias="SUBMISSION"/>
+  <MESSAGES><INFO>This submission is a TEST submission and will be discarded within 24 hours</INFO></MESSAGES>
+</RECEIPT>"""))
+    assert receipt.success
+    assert receipt.accessions == [("S1", "ERS000001", 'samples'),
+                                  ("exp_S1", "ERX000002", 'experiments'),
+                                  ("run_S1", "ERR000003", 'runs')]
+    assert receipt.accession("run_S1") == "ERR000003"
+    assert receipt.accession("S2") is None
+    assert receipt.errors == {}
+    assert list(receipt.infos) == [None]
+
+def test_parse_receipt_errors():
+    receipt = EnaClient.parse_receipt(io.BytesIO(b"""<RECEIPT success="false">
+  <SAMPLE alias="S1" status="PRIVATE"/>
+  <SAMPLE alias="S2" status="PRIVATE"/>
+  <MESSAGES>
+    <ERROR>In sample, alias:"S1", accession:"". Invalid serovar.</ERROR>
+    <ERROR>In sample, alias:"S1", accession:"". Invalid date.</ERROR>
+    <ERROR>In sample, alias:"S2", accession:"". Invalid date.</ERROR>
+    <ERROR>The object being added already exists.</ERROR>
+  </MESSAGES>
+</RECEIPT>"""))
+    assert not receipt.success
+    assert receipt.accessions == []
+    assert len(receipt.errors["S1"]) == 2
+    assert receipt.errors["S2"] == ['In sample, alias:"S2", accession:"". Invalid date.']
+    assert receipt.errors[None] == ["The object being added already exists."]
@@ -0,0 +1,117 @@
+import json
+import sqlite3
+
+import EnaSqlite
+
+def columns(db, table):
+    db.c.execute("PRAGMA table_info({});".format(table))
+    return [row[1] for row in db.c.fetchall()]
+
+def test_migrate_unversioned(tmp_path):
+    dbname = str(tmp_path / "ena.sqlite")
+    ## Tables as created before the DB was versioned, with the duplicate
+    #  rows every run used to add
+    connection = sqlite3.connect(dbname)
+    connection.executescript("""
+        CREATE TABLE projects (id INTEGER PRIMARY KEY, alias TEXT unique, accession TEXT unique);
+        CREATE TABLE samples (id INTEGER PRIMARY KEY, alias TEXT, accession TEXT);
+        CREATE TABLE runs (id INTEGER PRIMARY KEY, alias TEXT, accession TEXT, experiment_id INTEGER);
+        CREATE TABLE experiments (id INTEGER PRIMARY KEY, alias TEXT, accession TEXT, project_id INTEGER, sample_id INTEGER);
+        INSERT INTO samples (id, alias, accession) VALUES (1, 'S1', NULL), (2, 'S1', 'ERS1'), (3, 'S2', NULL);
+        INSERT INTO experiments (id, alias, accession, sample_id) VALUES (1, 'exp_S1', 'ERX1', 1), (2, 'exp_S1', NULL, 2);
+        INSERT INTO runs (id, alias, accession, experiment_id) VALUES (1, 'run_S1', 'ERR1', 2);
+    """)
+    connection.close()
+    db = EnaSqlite.Sqlitedb(dbname)
+    db.c.execute('PRAGMA user_version;')
+    assert db.c.fetchone()[0] == EnaSqlite.schema_version
+    db.c.execute("select alias, accession from samples order by alias;")
+    assert db.c.fetchall() == [('S1', 'ERS1'), ('S2', None)]
+    db.c.execute("select e.alias, e.accession, s.alias from experiments e join samples s on e.sample_id=s.id;")
+    assert db.c.fetchall() == [('exp_S1', 'ERX1', 'S1')]
+    db.c.execute("select r.alias, e.alias from runs r join experiments e on r.experiment_id=e.id;")
+    assert db.c.fetchall() == [('run_S1', 'exp_S1')]
+    assert 'digest' in columns(db, 'samples')
+    assert 'md5' in columns(db, 'uploads')
+    ## Opening it again leaves it alone
+    db.connection.close()
+    db = EnaSqlite.Sqlitedb(dbname)
+    db.c.execute("select count(*) from samples;")
+    assert db.c.fetchone()[0] == 2
+
+def test_migrate_jobs_attempts(tmp_path):
+    dbname = str(tmp_path / "ena.sqlite")
+    db = EnaSqlite.Sqlitedb(dbname)
+    db.connection.close()
+    ## A version 2 jobs table, which didn't count failed attempts
+    connection = sqlite3.connect(dbname)
+    connection.executescript("""
+        DROP TABLE jobs;
+        CREATE TABLE jobs (alias TEXT PRIMARY KEY, batch TEXT, project TEXT, files TEXT, stage TEXT, worker TEXT, claimed_at REAL, error TEXT);
+        INSERT INTO jobs (alias, batch, project, files, stage, error) VALUES ('S1', 'b', 'P', '[]', 'queued', 'rejected');
+        PRAGMA user_version=2;
+    """)
+    connection.close()
+    db = EnaSqlite.Sqlitedb(dbname)
+    assert 'attempts' in columns(db, 'jobs')
+    assert db.get_failed_jobs() == [('S1', 0, 'rejected')]
+
+def test_bulk_inserts(tmp_path):
+    db = EnaSqlite.Sqlitedb(str(tmp_path / "ena.sqlite"))
+    db.add_project("P")
+    for i in range(2):
+        ## Adding them again leaves them alone
+        db.add_samples(["S1", "S2"])
+        db.add_experiments([("exp_S1", "P", "S1"), ("exp_S2", "P", "S2")])
+        db.add_runs([("run_S1", "exp_S1"), ("run_S2", "exp_S2")])
+    db.c.execute("select r.alias, e.alias, s.alias from runs r join experiments e on r.experiment_id=e.id "
+                 "join samples s on e.sample_id=s.id order by r.alias;")
+    assert db.c.fetchall() == [('run_S1', 'exp_S1', 'S1'), ('run_S2', 'exp_S2', 'S2')]
+    db.add_accessions([("S1", "ERS1", 'samples'), ("exp_S1", "ERX1", 'experiments')])
+    db.add_accessions([("run_S1", "ERR1")], 'runs')
+    db.add_digests([("S1", "d1")], 'samples')
+    assert db.get_submitted('samples', ["S1", "S2"]) == {"S1": ("ERS1", "d1")}
+    assert db.get_accession("exp_S1", 'experiments') == "ERX1"
+    assert db.get_accession("run_S1", 'runs') == "ERR1"
+    assert db.get_experiment_projects(["exp_S1"]) == {"exp_S1": "P"}
+
+def add_jobs(db, aliases, batch="b"):
+    db.add_jobs([(alias, batch, "P", json.dumps(["{}_R1.fastq".format(alias)])) for alias in aliases])
+
+def claimed(jobs):
+    return sorted(job[0] for job in jobs)
+
+def test_claim_jobs(tmp_path):
+    db = EnaSqlite.Sqlitedb(str(tmp_path / "ena.sqlite"))
+    add_jobs(db, ["S1", "S2", "S3"])
+    add_jobs(db, ["T1"], batch="other")
+    assert claimed(db.claim_jobs("a", "b", limit=2)) == ["S1", "S2"]
+    assert claimed(db.claim_jobs("a", "b")) == ["S3"]
+    ## Claims of another worker are only taken over once they are stale
+    assert db.claim_jobs("b", "b") == []
+    assert claimed(db.claim_jobs("b", "b", stale_after=-1)) == ["S1", "S2", "S3"]
+    db.set_job_stage(["S1"], 'run_submitted')
+    db.release_jobs("b")
+    assert claimed(db.claim_jobs("a")) == ["S2", "S3", "T1"]
+    db.c.execute("select alias, stage, worker from jobs where alias='S1';")
+    assert db.c.fetchone() == ('S1', 'run_submitted', None)
+
+def test_claim_jobs_errors(tmp_path):
+    db = EnaSqlite.Sqlitedb(str(tmp_path / "ena.sqlite"))
+    add_jobs(db, ["S1", "S2"])
+    db.set_job_error(["S1"], "rejected")
+    db.set_job_error(["S1"], "rejected")
+    db.set_job_error(["S2"], "rejected")
+    ## Failed jobs are only retried on request, up to max_attempts times
+    assert claimed(db.claim_jobs("a")) == []
+    assert claimed(db.claim_jobs("a", retry_errors=True, max_attempts=2)) == ["S2"]
+    db.release_jobs("a")
+    assert claimed(db.claim_jobs("a", retry_errors=True)) == ["S1", "S2"]
+    assert sorted(db.get_failed_jobs("b")) == [('S1', 2, 'rejected'), ('S2', 1, 'rejected')]
+    ## Reaching a stage forgets the failures
+    db.set_job_stage(["S1"], 'uploaded')
+    db.release_jobs("a")
+    assert claimed(db.claim_jobs("a")) == ["S1"]
+    ## As does queueing a job again
+    add_jobs(db, ["S2"])
+    assert claimed(db.claim_jobs("b", stale_after=-1)) == ["S1", "S2"]
@@ -0,0 +1,60 @@
+import EnaWatch
+
+def fastq(path, reads=1):
+    path.write_text("@r\nACGT\n+\nIIII\n" * reads)
+    return str(path)
+
+class Clock:
+    """Stands in for time.monotonic and time.sleep"""
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+def test_scan_directory(tmp_path):
+    watcher = EnaWatch.Watcher(str(tmp_path))
+    pair = [fastq(tmp_path / "S1_R1.fastq"), fastq(tmp_path / "S1_R2.fastq")]
+    fastq(tmp_path / "S2_R1.fastq")
+    (tmp_path / "S3_R1.txt").write_text("")
+    (tmp_path / "S3_R2.txt").write_text("")
+    ## Sizes have to hold still between two scans
+    assert watcher.scan() == []
+    assert watcher.scan() == [pair]
+    assert watcher.scan() == []
+    fastq(tmp_path / "S2_R2.fastq")
+    fastq(tmp_path / "S2_R1.fastq", reads=2)
+    assert watcher.scan() == []
+    assert watcher.scan() == [[str(tmp_path / "S2_R1.fastq"), str(tmp_path / "S2_R2.fastq")]]
+
+def test_scan_list(tmp_path):
+    fastq_list = tmp_path / "fastqs.tsv"
+    fastq_list.write_text("#comment\nS1_R1.fastq\tS1_R2.fastq\n\nS2_R1.fastq\tS2")
+    watcher = EnaWatch.Watcher(str(fastq_list))
+    assert watcher.scan() == [["S1_R1.fastq", "S1_R2.fastq"]]
+    ## The last line is still being written
+    with open(fastq_list, 'a') as fh:
+        fh.write("_R2.fastq\n")
+    assert watcher.scan() == [["S2_R1.fastq", "S2_R2.fastq"]]
+    assert watcher.scan() == []
+
+def test_batches(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(EnaWatch, 'time', clock)
+    fastq_list = tmp_path / "fastqs.tsv"
+    fastq_list.write_text("".join("S{0}_R1.fastq\tS{0}_R2.fastq\n".format(i) for i in range(3)))
+    watcher = EnaWatch.Watcher(str(fastq_list), batch_size=2, window=30, poll=10)
+    batches = watcher.batches()
+    assert [pair[0] for pair in next(batches)] == ["S0_R1.fastq", "S1_R1.fastq"]
+    ## The leftover goes once it has waited the window since it arrived
+    with open(fastq_list, 'a') as fh:
+        fh.write("S3_R1.fastq\tS3_R2.fastq\n")
+    assert [pair[0] for pair in next(batches)] == ["S2_R1.fastq", "S3_R1.fastq"]
+    with open(fastq_list, 'a') as fh:
+        fh.write("S4_R1.fastq\tS4_R2.fastq\n")
+    start = clock.now
+    assert [pair[0] for pair in next(batches)] == ["S4_R1.fastq"]
+    assert clock.now - start == 40
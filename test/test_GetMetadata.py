@@ -0,0 +1,78 @@
+import os
+
+import GetMetadata
+
+header = "isolate\tserovar\tST\tdate\ttravel\n"
+
+def line(isolate, serovar="Typhimurium"):
+    return "{}\t{}\t19\t01-02-2020\tDANMARK\n".format(isolate, serovar)
+
+def write(path, text, mtime=None):
+    path.write_text(text)
+    if mtime is not None:
+        os.utime(path, ns=(mtime, mtime))
+
+def serovars(index):
+    return {alias: a['serovar'] for alias, a in index.lookup(None).items()}
+
+def test_parse_isolate():
+    isolate, attributes = GetMetadata.parse_isolate(line("S1"))
+    assert isolate == "S1"
+    assert attributes == {'isolate': "S1", 'serovar': "Typhimurium", 'sub_type': "ST19",
+                          'collection date': "2020-02", 'travel-relation': "not travel-related"}
+
+def test_refresh_appended(tmp_path):
+    export = tmp_path / "export.tsv"
+    write(export, header + line("S1") + line("S2"))
+    index = GetMetadata.IsolateIndex(str(tmp_path / "index.sqlite"))
+    index.refresh(str(export))
+    assert sorted(index.lookup(["S1", "S2", "S3"])) == ["S1", "S2"]
+    with open(export, 'a') as fh:
+        fh.write(line("S3"))
+    index.refresh(str(export))
+    assert sorted(index.lookup(["S1", "S2", "S3"])) == ["S1", "S2", "S3"]
+
+def test_refresh_incomplete_line(tmp_path):
+    export = tmp_path / "export.tsv"
+    write(export, header + line("S1") + line("S2").rstrip('\n'))
+    index = GetMetadata.IsolateIndex(str(tmp_path / "index.sqlite"))
+    index.refresh(str(export))
+    ## The last line is still being written
+    assert sorted(index.lookup(None)) == ["S1"]
+    with open(export, 'a') as fh:
+        fh.write("\n")
+    index.refresh(str(export))
+    assert sorted(index.lookup(None)) == ["S1", "S2"]
+
+def test_refresh_changed_in_place(tmp_path):
+    export = tmp_path / "export.tsv"
+    rest = "".join(line("T{}".format(i)) for i in range(500))
+    write(export, header + line("S1", "Enteritidis") + rest, mtime=10**18)
+    index = GetMetadata.IsolateIndex(str(tmp_path / "index.sqlite"))
+    index.refresh(str(export), blocksize=1024)
+    ## A correction of the same length far before the end, and a line appended
+    write(export, header + line("S1", "Dublin12345") + rest + line("S2"), mtime=2*10**18)
+    index.refresh(str(export), blocksize=1024)
+    assert serovars(index)["S1"] == "Dublin12345"
+    assert serovars(index)["S2"] == "Typhimurium"
+    assert len(index.lookup(None)) == 502
+
+def test_refresh_rewritten(tmp_path):
+    export = tmp_path / "export.tsv"
+    write(export, header + line("S1") + line("S2"))
+    index = GetMetadata.IsolateIndex(str(tmp_path / "index.sqlite"))
+    index.refresh(str(export))
+    write(export, header + line("S3"))
+    index.refresh(str(export))
+    assert sorted(index.lookup(None)) == ["S3"]
+
+def test_metadata_with_index(tmp_path):
+    export = tmp_path / "export.tsv"
+    write(export, header + line("S1") + line("S2"))
+    index = GetMetadata.IsolateIndex(":memory:")
+    with open(export) as fh:
+        metadata = GetMetadata.metadata(fh, "ERC000029", ["S1"], index)
+    assert "S1" in metadata and "S2" not in metadata
+    attributes = metadata.get("S1")
+    assert attributes['ENA_CHECKLIST'] == "ERC000029"
+    assert attributes['serovar'] == "Typhimurium"
@@ -0,0 +1,74 @@
+import io
+import json
+
+import pytest
+
+import Metrics
+
+def events(log):
+    return [json.loads(line) for line in log.getvalue().splitlines()]
+
+def test_json_lines():
+    log = io.StringIO()
+    metrics = Metrics.Metrics(log)
+    with metrics.timer('upload', file="S1_R1.fastq") as fields:
+        fields['bytes'] = 100
+    with pytest.raises(ValueError):
+        with metrics.timer('post.SAMPLE', objects=2):
+            raise ValueError("nope")
+    metrics.outcome("S1", 'SAMPLE', 'failed', ["Invalid date."])
+    upload, post, outcome = events(log)
+    assert upload['event'] == 'upload'
+    assert upload['file'] == "S1_R1.fastq" and upload['bytes'] == 100
+    assert upload['seconds'] >= 0
+    assert post['objects'] == 2 and post['error'] == "ValueError('nope')"
+    assert (outcome['alias'], outcome['object'], outcome['outcome'], outcome['errors']) == \
+        ("S1", 'SAMPLE', 'failed', ["Invalid date."])
+
+def test_prometheus(tmp_path):
+    path = str(tmp_path / "metrics.prom")
+    metrics = Metrics.Metrics(prometheus_file=path)
+    metrics.observe('upload', 1.5, bytes=100)
+    metrics.observe('upload', 0.5, bytes=50)
+    metrics.observe('post.SAMPLE', 2.0, error="HTTPError()")
+    metrics.count('retries', stage='post.SAMPLE')
+    metrics.outcome("S1", 'SAMPLE', 'accepted')
+    metrics.close()
+    assert open(path).read() == """# TYPE enaupload_stage_seconds summary
+enaupload_stage_seconds_sum{stage="post.SAMPLE"} 2.0
+enaupload_stage_seconds_count{stage="post.SAMPLE"} 1
+enaupload_stage_seconds_sum{stage="upload"} 2.0
+enaupload_stage_seconds_count{stage="upload"} 2
+# TYPE enaupload_bytes_total counter
+enaupload_bytes_total{stage="upload"} 150
+# TYPE enaupload_errors_total counter
+enaupload_errors_total{stage="post.SAMPLE"} 1
+# TYPE enaupload_objects_total counter
+enaupload_objects_total{object="SAMPLE",outcome="accepted"} 1
+# TYPE enaupload_retries_total counter
+enaupload_retries_total{stage="post.SAMPLE"} 1
+"""
+
+def test_disabled():
+    metrics = Metrics.Metrics()
+    with metrics.timer('upload') as fields:
+        fields['bytes'] = 100
+    metrics.count('retries')
+    assert metrics.durations == {} and metrics.counters == {}
+
+class Timed:
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    @Metrics.timed("db.work")
+    def work(self):
+        return 42
+
+def test_timed():
+    log = io.StringIO()
+    metrics = Metrics.Metrics(log)
+    assert Timed(metrics).work() == 42
+    assert Timed(metrics).work() == 42
+    assert metrics.durations['db.work'][0] == 2
+    ## Summed up but not logged
+    assert log.getvalue() == ""